@@ -5,6 +5,23 @@ DATA_START_ROW = 4
 
 XLS_PATH = "/Users/ian/Dropbox/code/private-code/poa-xls-files/csv-input-v1.06/"
 
+# directory to keep parsed CSV snapshots between runs, None to always parse the CSV files
+CSV_CACHE_DIR = None
+
+# SQLite database file to import the CSV files into and read instead of the CSV files,
+# None to read the CSV files
+CSV_DATABASE = None
+
+# file recording the CSV rows of each article when its XML was generated, so only
+# changed articles are generated again, None to generate every article
+FINGERPRINT_LEDGER = None
+
+# number of values kept by memoized lookups of single articles, None for no limit
+MEMOIZE_MAX_SIZE = 10000
+
+# number of generated XML files waiting to be written by the background writer
+XML_WRITE_QUEUE_SIZE = 20
+
 
 
 
@@ -79,6 +96,10 @@ EJP_INPUT_DIR = "sample-zip-from-ejp"
 STAGING_DECAPITATE_PDF_DIR = "staging_decapitate_pdf_dir"
 TMP_DIR = "tmp"
 
+# named HTML entities converted to unicode in addition to the built in ones,
+# for example {"mu": u"\u03bc"} to replace &mu;
+ENTITY_REPLACEMENTS = {}
+
 LESS_THAN_ESCAPE_SEQUENCE = 'LTLT'
 GREATER_THAN_ESCAPE_SEQUENCE = 'GTGT'
 MATCH_TEXT = `3`
@@ -4,7 +4,6 @@ from xml.dom import minidom
 import datetime
 import time
 import os
-from git import *
 from generatePoaXml import *
 from xml_generation import *
 from parsePoaXml import *
@@ -16,11 +15,12 @@ import settings
 
 class crossrefXML(object):
 
-    def __init__(self, poa_articles, pub_date=None):
+    def __init__(self, poa_articles, pub_date=None, provenance=None):
         """
         set the root node
         get the article type from the object passed in to the class
         set default values for items that are boilder plate for this XML
+        provenance is a get_provenance dict, by default the one for this process
         """
         self.root = Element('doi_batch')
 
@@ -57,10 +57,7 @@ class crossrefXML(object):
                                    time.strftime("%Y%m%d%H%M%S", self.pub_date))
 
         # set comment
-        generated = time.strftime("%Y-%m-%d %H:%M:%S")
-        last_commit = get_last_commit_to_master()
-        comment = Comment('generated by eLife at ' + generated + ' from version ' + last_commit)
-        self.root.append(comment)
+        self.root.append(get_provenance_comment(provenance))
 
         self.build(self.root, poa_articles)
 
@@ -197,10 +194,8 @@ class crossrefXML(object):
         tag_converted_title = replace_tags(tag_converted_title, 'bold', 'b')
         tag_converted_title = replace_tags(tag_converted_title, 'underline', 'u')
         tagged_string = '<' + tag_name + '>' + tag_converted_title + '</' + tag_name + '>'
-        reparsed = minidom.parseString(xml_escape_ampersand(tagged_string).encode('utf-8'))
-
-        root_xml_element = append_minidom_xml_to_elementtree_xml(
-            root_xml_element, reparsed
+        root_xml_element = append_xml_fragment_to_elementtree_xml(
+            root_xml_element, xml_escape_ampersand(tagged_string).encode('utf-8')
             )
 
         parent.append(root_xml_element)
@@ -336,11 +331,8 @@ class crossrefXML(object):
         tagged_string = '<' + tag_name + namespaces + attributes_text + '>'
         tagged_string += tag_converted_abstract
         tagged_string += '</' + tag_name + '>'
-        reparsed = minidom.parseString(tagged_string.encode('utf-8'))
-
-        recursive = False
-        root_xml_element = append_minidom_xml_to_elementtree_xml(
-            parent, reparsed, recursive, attributes
+        root_xml_element = append_xml_fragment_to_elementtree_xml(
+            parent, tagged_string.encode('utf-8'), attributes
         )
 
     def set_publication_date(self, parent, pub_date):
@@ -520,10 +512,8 @@ class crossrefXML(object):
             tag_converted_string = replace_tags(tag_converted_string, 'bold', 'b')
             tag_converted_string = replace_tags(tag_converted_string, 'underline', 'u')
             tagged_string = '<' + tag_name + '>' + tag_converted_string + '</' + tag_name + '>'
-            reparsed = minidom.parseString(tagged_string.encode('utf-8'))
-
-            root_xml_element = append_minidom_xml_to_elementtree_xml(
-                parent, reparsed
+            root_xml_element = append_xml_fragment_to_elementtree_xml(
+                parent, tagged_string.encode('utf-8')
             )
         else:
             # Empty
@@ -581,11 +571,9 @@ class crossrefXML(object):
     def prettyXML(self):
         encoding = 'utf-8'
 
-        rough_string = ElementTree.tostring(self.root, encoding)
-        reparsed = minidom.parseString(rough_string)
-
-        #return reparsed.toprettyxml(indent="\t", encoding = encoding)
-        return reparsed.toxml(encoding=encoding)
+        stream = StringIO()
+        write_xml_document(stream, self.root, encoding=encoding)
+        return stream.getvalue()
 
 def build_crossref_xml_for_articles(poa_articles):
     """
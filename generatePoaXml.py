@@ -1,9 +1,12 @@
 from xml.etree.ElementTree import Element, SubElement, Comment
 from xml.etree import ElementTree
 from xml.dom import minidom
+from xml.parsers import expat
 import time
 import re
-from git import *
+import os
+import itertools
+from cStringIO import StringIO
 import settings
 
 """
@@ -25,11 +28,12 @@ does pretty printing.
 
 class eLife2XML(object):
 
-    def __init__(self, poa_article):
+    def __init__(self, poa_article, provenance=None):
         """
         set the root node
         get the article type from the object passed in to the class
         set default values for items that are boilder plate for this XML
+        provenance is a get_provenance dict, by default the one for this process
         """
         self.root = Element('article')
 
@@ -48,10 +52,7 @@ class eLife2XML(object):
         self.root.set('dtd-version', '1.1d3')
 
         # set comment
-        generated = time.strftime("%Y-%m-%d %H:%M:%S")
-        last_commit = get_last_commit_to_master()
-        comment = Comment('generated by eLife at ' + generated + ' from version ' + last_commit)
-        self.root.append(comment)
+        self.root.append(get_provenance_comment(provenance))
 
         # contributor conflict count, incremented when printing contrib xref
         self.conflict_count = 0
@@ -68,6 +69,10 @@ class eLife2XML(object):
         # author aff count, and dict of author affiliations by index
         self.author_aff_count = 0
         self.author_affs = {}
+        # aff_id of author affiliations indexed by index_aff, and the
+        # attributes each has, for matching affiliations in get_aff_id
+        self.author_aff_index = {}
+        self.author_aff_attrs = set()
 
         self.build(self.root, poa_article)
 
@@ -177,6 +182,7 @@ class eLife2XML(object):
         self.set_title_group(self.article_meta, poa_article)
 
         #
+        self.contrib_par_ids = self.get_contrib_par_ids_map(poa_article)
         for contrib_type in self.contrib_types:
             self.set_contrib_group(self.article_meta, poa_article, contrib_type)
         #
@@ -306,10 +312,8 @@ class eLife2XML(object):
 
         # XML
         tagged_string = '<' + tag_name + '>' + title + '</' + tag_name + '>'
-        reparsed = minidom.parseString(tagged_string)
-
-        root_xml_element = append_minidom_xml_to_elementtree_xml(
-            root_xml_element, reparsed
+        root_xml_element = append_xml_fragment_to_elementtree_xml(
+            root_xml_element, tagged_string
             )
 
         parent.append(root_xml_element)
@@ -427,10 +431,8 @@ class eLife2XML(object):
 
         # XML
         tagged_string = '<' + tag_name + '>' + abstract + '</' + tag_name + '>'
-        reparsed = minidom.parseString(tagged_string)
-
-        root_xml_element = append_minidom_xml_to_elementtree_xml(
-            root_xml_element, reparsed
+        root_xml_element = append_xml_fragment_to_elementtree_xml(
+            root_xml_element, tagged_string
             )
 
         parent.append(root_xml_element)
@@ -441,36 +443,63 @@ class eLife2XML(object):
         and keep track of all the affs in a dict
         This can be assembled by processing each author aff in succession
         Return the new or existing aff_id dict index
+
+        As with compare_aff an attribute missing from either affiliation matches,
+        so an existing affiliation matches if it is equal on the attributes both
+        have. For each set of attributes the existing affiliations have, look up
+        their values on those the new one also has, and use the last aff_id found
         """
+        key = get_aff_key(affiliation)
         aff_id = None
 
-        for key, value in self.author_affs.iteritems():
-            if self.compare_aff(affiliation, value):
-                aff_id = key
+        for aff_attrs in self.author_aff_attrs:
+            compared_attrs = tuple(index for index in aff_attrs if key[index] is not None)
+            index_key = (aff_attrs, compared_attrs, tuple(key[index] for index in compared_attrs))
+            matched_aff_id = self.author_aff_index.get(index_key)
+            if matched_aff_id and (aff_id is None or matched_aff_id > aff_id):
+                aff_id = matched_aff_id
         if not aff_id:
             self.author_aff_count += 1
             aff_id = self.author_aff_count
             self.author_affs[aff_id] = affiliation
+            self.index_aff(aff_id, key)
 
         return aff_id
+
+    def index_aff(self, aff_id, key):
+        """
+        Index the aff_id on its values for each subset of the attributes the
+        affiliation has, a later aff_id replaces an earlier one
+        """
+        aff_attrs = tuple(index for index, value in enumerate(key) if value is not None)
+        self.author_aff_attrs.add(aff_attrs)
+        for count in range(len(aff_attrs) + 1):
+            for compared_attrs in itertools.combinations(aff_attrs, count):
+                index_key = (aff_attrs, compared_attrs, tuple(key[index] for index in compared_attrs))
+                self.author_aff_index[index_key] = aff_id
     
     def get_contrib_par_ids(self, poa_article, auth_id):
         """
         In order to set xref tags for authors that link to funding award id
         traverse the article data to match values
         """
-        par_ids = []
+        return self.get_contrib_par_ids_map(poa_article).get(auth_id, [])
+
+    def get_contrib_par_ids_map(self, poa_article):
+        """
+        The get_contrib_par_ids of every principal award recipient, by auth_id,
+        traversing the funding awards once for the article
+        """
+        contrib_par_ids = {}
         for index, award in enumerate(poa_article.funding_awards):
             par_id = "par-" + str(index + 1)
             for contributor in award.principal_award_recipients:
-                if contributor.auth_id == auth_id:
-                    par_ids.append(par_id)
-        return par_ids
+                contrib_par_ids.setdefault(contributor.auth_id, []).append(par_id)
+        return contrib_par_ids
 
     def compare_aff(self, aff1, aff2):
         # Compare two affiliations by comparing the object attributes
-        attrs = ['city', 'country', 'department', 'institution']
-        for attr in attrs:
+        for attr in AFF_COMPARE_ATTRS:
             if (getattr(aff1, attr) and
                 getattr(aff2, attr) and
                 getattr(aff1, attr) != getattr(aff2, attr)):
@@ -536,7 +565,7 @@ class eLife2XML(object):
                 self.xref.text = "*"
 
             # Funding award group xref tags
-            for par_id in self.get_contrib_par_ids(poa_article, contributor.auth_id):
+            for par_id in self.contrib_par_ids.get(contributor.auth_id, []):
                 self.xref = SubElement(self.contrib, "xref")
                 self.xref.set("ref-type", "other")
                 self.xref.set("rid", par_id)
@@ -764,13 +793,18 @@ class eLife2XML(object):
         doctype = ElifeDocumentType(qualifiedName)
         doctype._identified_mixin_init(publicId, systemId)
 
-        rough_string = ElementTree.tostring(self.root, encoding)
-        reparsed = minidom.parseString(rough_string)
-        if doctype:
-            reparsed.insertBefore(doctype, reparsed.documentElement)
-        #return reparsed.toprettyxml(indent="\t", encoding = encoding)
-        # Switch to toxml() instead of toprettyxml() to solve extra whitespace issues
-        return reparsed.toxml(encoding=encoding)
+        stream = StringIO()
+        write_xml_document(stream, self.root, doctype, encoding)
+        return stream.getvalue()
+
+# Attributes compare_aff compares, a missing value matches any other value
+AFF_COMPARE_ATTRS = ['city', 'country', 'department', 'institution']
+
+def get_aff_key(affiliation):
+    """
+    Values of the AFF_COMPARE_ATTRS of an affiliation, None where it has no value
+    """
+    return tuple(getattr(affiliation, attr) or None for attr in AFF_COMPARE_ATTRS)
 
 class ContributorAffiliation():
     phone = None
@@ -1065,6 +1099,84 @@ class ElifeDocumentType(minidom.DocumentType):
             writer.write("]")
         writer.write(">"+newl)
 
+# Characters which are not allowed in XML 1.0, an XML parser fails on them
+INVALID_XML_CHARS_PATTERN = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def minidom_escape(s):
+    """
+    Escape text and attribute values as minidom writes them
+    """
+    return s.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def normalize_newlines(s):
+    """
+    Carriage returns become new lines when the XML is parsed
+    """
+    if "\r" in s:
+        s = s.replace("\r\n", "\n").replace("\r", "\n")
+    return s
+
+def normalize_attribute_value(s):
+    """
+    New lines in attributes are written as character references and kept when
+    the XML is parsed, carriage returns and tabs become spaces
+    """
+    if "\r" in s or "\t" in s:
+        s = s.replace("\r", " ").replace("\t", " ")
+    return s
+
+def append_element_xml(parts, element):
+    """
+    Append the XML of an ElementTree element and its tail to parts, written
+    the same as minidom toxml() writes it after parsing the ElementTree XML
+    """
+    if element.tag is Comment:
+        text = normalize_newlines(element.text or "")
+        if "--" in text or text.endswith("-"):
+            raise ValueError("not well-formed comment: " + repr(text))
+        parts.append("<!--" + text + "-->")
+    else:
+        parts.append("<" + element.tag)
+        for name, value in sorted(element.items()):
+            parts.append(" " + name + '="' +
+                         minidom_escape(normalize_attribute_value(value)) + '"')
+        if element.text or len(element):
+            parts.append(">")
+            if element.text:
+                parts.append(minidom_escape(normalize_newlines(element.text)))
+            for child in element:
+                append_element_xml(parts, child)
+            parts.append("</" + element.tag + ">")
+        else:
+            parts.append("/>")
+    if element.tail:
+        parts.append(minidom_escape(normalize_newlines(element.tail)))
+
+def write_xml_document(stream, root, doctype=None, encoding='utf-8'):
+    """
+    Write the XML declaration, the DOCTYPE if there is one, and the root element to
+    the stream, encoded the same as minidom toxml(encoding) after parsing the
+    ElementTree XML and inserting the DOCTYPE, without building the DOM
+    """
+    parts = ['<?xml version="1.0" encoding="' + encoding + '"?>']
+    if doctype is not None:
+        doctype_stream = StringIO()
+        doctype.writexml(doctype_stream)
+        parts.append(doctype_stream.getvalue())
+    # The tail of the root is outside the document
+    tail = root.tail
+    root.tail = None
+    try:
+        append_element_xml(parts, root)
+    finally:
+        root.tail = tail
+    xml = u"".join(parts)
+    invalid_char_match = INVALID_XML_CHARS_PATTERN.search(xml)
+    if invalid_char_match:
+        raise ValueError("not well-formed, invalid character " +
+                         repr(invalid_char_match.group()))
+    stream.write(xml.encode(encoding))
+
 def elife_journal_volume(pub_date):
     """
     volume value is based on the pub date year
@@ -1081,12 +1193,44 @@ def repl(m):
     chr_code = int(m.group(1), 16)
     return unichr(chr_code)
 
+# Selected named entity replacements that have been seen, and any added in settings
+ENTITY_REPLACEMENTS = {
+    "alpha": u"\u03b1",
+    "beta": u"\u03b2",
+    "gamma": u"\u03b3",
+    "delta": u"\u03b4",
+    "epsilon": u"\u03b5",
+    "ordm": u"\u00ba",
+    "iuml": u"\u00cf",
+    "ldquo": '"',
+    "rdquo": '"',
+}
+ENTITY_REPLACEMENTS.update(settings.ENTITY_REPLACEMENTS)
+
+def compile_entity_pattern():
+    """
+    Numeric entities in group 1, named entities from ENTITY_REPLACEMENTS in group 2,
+    compile again after changing ENTITY_REPLACEMENTS
+    """
+    global ENTITY_PATTERN
+    ENTITY_PATTERN = re.compile(r"&(?:#x(....)|(" +
+                                "|".join(map(re.escape, sorted(ENTITY_REPLACEMENTS))) + "));")
+
+compile_entity_pattern()
+
+def entity_repl(m):
+    if m.group(1) is not None:
+        return repl(m)
+    return ENTITY_REPLACEMENTS[m.group(2)]
+
 def get_last_commit_to_master():
     """
     returns the last commit on the master branch. It would be more ideal to get the commit
     from the branch we are currently on, but as this is a check mostly to help
     with production issues, returning the commit from master will be sufficient.
     """
+    # Imported here so git is only needed when the version is not set
+    from git import Repo
     repo = Repo(".")
     last_commit = None
     try:
@@ -1098,29 +1242,47 @@ def get_last_commit_to_master():
     # commit =  repo.heads[0].commit
     # return str(commit)
 
+# The version in the generated by comment is read from this environment variable,
+# or else this file, for hosts without a git checkout, or else from git
+VERSION_ENVIRONMENT_VARIABLE = "ELIFE_POA_XML_VERSION"
+VERSION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "version.txt")
+
+def get_version():
+    version = os.environ.get(VERSION_ENVIRONMENT_VARIABLE)
+    if version:
+        return version.strip()
+    if os.path.exists(VERSION_FILE):
+        with open(VERSION_FILE, "rb") as open_file:
+            return open_file.read().strip()
+    return get_last_commit_to_master()
+
+# The get_provenance dict of this process
+provenance = None
+
+def get_provenance():
+    """
+    The generated timestamp and version written in the generated by comment
+    of each document, resolved once for the process
+    """
+    global provenance
+    if provenance is None:
+        provenance = {"generated": time.strftime("%Y-%m-%d %H:%M:%S"),
+                      "version": get_version()}
+    return provenance
+
+def get_provenance_comment(provenance=None):
+    if provenance is None:
+        provenance = get_provenance()
+    return Comment('generated by eLife at ' + provenance["generated"] +
+                   ' from version ' + provenance["version"])
+
 def entity_to_unicode(s):
     """
     Quick convert unicode HTML entities to unicode characters
-    using a regular expression replacement
+    using a regular expression replacement, numeric entities and
+    those in ENTITY_REPLACEMENTS are replaced in one pass
     """
-    # Selected character replacements that have been seen
-    replacements = []
-    replacements.append((r"&alpha;", u"\u03b1"))
-    replacements.append((r"&beta;", u"\u03b2"))
-    replacements.append((r"&gamma;", u"\u03b3"))
-    replacements.append((r"&delta;", u"\u03b4"))
-    replacements.append((r"&epsilon;", u"\u03b5"))
-    replacements.append((r"&ordm;", u"\u00ba"))
-    replacements.append((r"&iuml;", u"\u00cf"))
-    replacements.append((r"&ldquo;", '"'))
-    replacements.append((r"&rdquo;", '"'))
-
-    # First, replace numeric entities with unicode
-    s = re.sub(r"&#x(....);", repl, s)
-    # Second, replace some specific entities specified in the list
-    for entity, replacement in replacements:
-        s = re.sub(entity, replacement, s)
-    return s
+    return ENTITY_PATTERN.sub(entity_repl, s)
 
 def xml_escape_ampersand(s):
     """
@@ -1151,14 +1313,8 @@ def replace_tags(s, from_tag='i', to_tag='italic'):
     s = s.replace('</' + from_tag + '>', '</' + to_tag + '>')
     return s
 
-def escape_unmatched_angle_brackets(s):
-    """
-    In order to make an XML string less malformed, escape
-    unmatched less than tags that are not part of an allowed tag
-    Note: Very, very basic, and do not try regex \1 style replacements
-      on unicode ever again! Instead this uses string replace
-    """
-    allowed_tags = ['<i>', '</i>',
+# Tags kept by escape_unmatched_angle_brackets
+ALLOWED_TAGS = set(['<i>', '</i>',
                     '<italic>', '</italic>',
                     '<b>', '</b>',
                     '<bold>', '</bold>',
@@ -1166,37 +1322,56 @@ def escape_unmatched_angle_brackets(s):
                     '<sub>', '</sub>',
                     '<u>', '</u>',
                     '<underline>', '</underline>',
-                    '<b>', '</b>',
-                    '<bold>', '</bold>',
-                    '<p>', '</p>']
-
-    # Split string on tags
-    tags = re.split('(<.*?>)', s)
-    #print tags
+                    '<p>', '</p>'])
 
-    for i in range(len(tags)):
-        val = tags[i]
+def escape_angle_brackets(s):
+    return s.replace('<', '&lt;').replace('>', '&gt;')
 
-        # Use angle bracket character counts to find unmatched tags
-        #  as well as our allowed_tags list to ignore good tags
+def escape_unmatched_angle_brackets(s):
+    """
+    In order to make an XML string less malformed, escape
+    unmatched less than tags that are not part of an allowed tag
+    Note: Very, very basic, and do not try regex \1 style replacements
+      on unicode ever again! Instead this uses string replace
 
-        if val.count('<') == val.count('>') and val not in allowed_tags:
-            val = val.replace('<', '&lt;')
-            val = val.replace('>', '&gt;')
+    A tag is a < followed by the first > on the same line, angle brackets
+    outside tags are escaped, as are all but the last < in a tag, and the tag
+    itself unless it is in ALLOWED_TAGS. The string is scanned once, keeping the
+    position of the next > and new line so none is searched for twice
+    """
+    parts = []
+    text_start = 0
+    search_start = 0
+    next_gt = -1
+    next_newline = None
+    while True:
+        lt = s.find('<', search_start)
+        if lt == -1:
+            break
+        if next_gt < lt:
+            next_gt = s.find('>', lt + 1)
+            if next_gt == -1:
+                # No tag can close after this
+                break
+        if next_newline is None or -1 < next_newline < lt:
+            next_newline = s.find('\n', lt + 1)
+        if next_newline != -1 and next_newline < next_gt:
+            # No tag starts on this line
+            search_start = next_newline + 1
+            continue
+
+        parts.append(escape_angle_brackets(s[text_start:lt]))
+        tag = s[lt:next_gt + 1]
+        last_lt = tag.rfind('<')
+        parts.append(tag[:last_lt].replace('<', '&lt;'))
+        if tag[last_lt:] in ALLOWED_TAGS:
+            parts.append(tag[last_lt:])
         else:
-            # Count how many unmatched tags we have
-            while val.count('<') != val.count('>'):
-                if val.count('<') != val.count('>') and val.count('<') > 0:
-                    val = val.replace('<', '&lt;', 1)
-                elif val.count('<') != val.count('>') and val.count('>') > 0:
-                    val = val.replace('>', '&gt;', 1)
-            if val.count('<') == val.count('>') and val not in allowed_tags:
-                # Send it through again in case there are nested unmatched tags
-                val = escape_unmatched_angle_brackets(val)
-
-        tags[i] = val
+            parts.append(escape_angle_brackets(tag[last_lt:]))
+        text_start = search_start = next_gt + 1
 
-    return ''.join(tags)
+    parts.append(escape_angle_brackets(s[text_start:]))
+    return ''.join(parts)
 
 def convert_to_xml_string(s):
     """
@@ -1271,6 +1446,68 @@ def append_minidom_xml_to_elementtree_xml(parent, xml, recursive=False, attribut
 
     return parent
 
+def get_qualified_name(name):
+    """
+    The prefixed name of a tag or attribute from an expat parser with namespace
+    processing, which gives it as the namespace URI, local name and prefix
+    """
+    parts = name.split(" ")
+    if len(parts) == 3:
+        return parts[2] + ":" + parts[1]
+    return parts[-1]
+
+def append_xml_fragment_to_elementtree_xml(parent, xml, attributes=None):
+    """
+    Parse a snippet of XML such as <p>text with <italic>tags</italic></p>
+    straight into a new ElementTree.SubElement of parent, the same as parsing it
+    with minidom and append_minidom_xml_to_elementtree_xml without the DOM
+    attributes: a list of attribute names to copy from the snippet root tag,
+    the attributes of the tags inside it are not copied
+    """
+    open_elements = []
+
+    def start_element(name, attrs):
+        if open_elements:
+            open_elements.append(SubElement(open_elements[-1], get_qualified_name(name)))
+            return
+        new_elem = SubElement(parent, get_qualified_name(name))
+        if attributes:
+            attrs = dict((get_qualified_name(attr_name), value)
+                         for attr_name, value in attrs.items())
+            for attribute in attributes:
+                if attrs.get(attribute):
+                    new_elem.set(attribute, attrs[attribute])
+        open_elements.append(new_elem)
+
+    def end_element(name):
+        open_elements.pop()
+
+    def character_data(data):
+        if not open_elements:
+            return
+        elem = open_elements[-1]
+        if len(elem):
+            elem[-1].tail = (elem[-1].tail or "") + data
+        else:
+            elem.text = (elem.text or "") + data
+
+    def not_supported(*args):
+        # append_minidom_xml_to_elementtree_xml only copies tags and text
+        raise ValueError("comments, processing instructions and CDATA are not supported")
+
+    parser = expat.ParserCreate(namespace_separator=" ")
+    parser.namespace_prefixes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    parser.CommentHandler = not_supported
+    parser.ProcessingInstructionHandler = not_supported
+    parser.StartCdataSectionHandler = not_supported
+    parser.Parse(xml, True)
+
+    return parent
+
 
 if __name__ == '__main__':
 
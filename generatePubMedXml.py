@@ -5,7 +5,6 @@ import datetime
 import time
 import re
 import os
-from git import *
 from generatePoaXml import *
 from xml_generation import *
 from parsePoaXml import *
@@ -19,11 +18,12 @@ class pubMedPoaXML(object):
     """
     Generate PubMed XML for the PoA article, which is pubstatus = "aheadofprint"
     """
-    def __init__(self, poa_articles, pub_date=None):
+    def __init__(self, poa_articles, pub_date=None, provenance=None):
         """
         set the root node
         get the article type from the object passed in to the class
         set default values for items that are boilder plate for this XML
+        provenance is a get_provenance dict, by default the one for this process
         """
         self.root = Element('ArticleSet')
 
@@ -48,10 +48,7 @@ class pubMedPoaXML(object):
                                    + "-PubMed")
 
         # set comment
-        generated = time.strftime("%Y-%m-%d %H:%M:%S")
-        last_commit = get_last_commit_to_master()
-        comment = Comment('generated by eLife at ' + generated + ' from version ' + last_commit)
-        self.root.append(comment)
+        self.root.append(get_provenance_comment(provenance))
 
         self.build(self.root, poa_articles)
 
@@ -159,10 +156,8 @@ class pubMedPoaXML(object):
             tag_converted_title = tag_converted_title.rstrip('</b>')
         tag_converted_title = escape_unmatched_angle_brackets(tag_converted_title)
         tagged_string = '<' + tag_name + '>' + tag_converted_title + '</' + tag_name + '>'
-        reparsed = minidom.parseString(xml_escape_ampersand(tagged_string).encode('utf-8'))
-
-        root_xml_element = append_minidom_xml_to_elementtree_xml(
-            parent, reparsed
+        root_xml_element = append_xml_fragment_to_elementtree_xml(
+            parent, xml_escape_ampersand(tagged_string).encode('utf-8')
         )
 
     def set_e_location_id(self, parent, poa_article):
@@ -368,10 +363,8 @@ class pubMedPoaXML(object):
                 tag_converted_abstract = tag_converted_abstract.replace(tagname, '')
             tag_converted_abstract = escape_unmatched_angle_brackets(tag_converted_abstract)
             tagged_string = '<' + tag_name + '>' + tag_converted_abstract + '</' + tag_name + '>'
-            reparsed = minidom.parseString(tagged_string.encode('utf-8'))
-
-            root_xml_element = append_minidom_xml_to_elementtree_xml(
-                parent, reparsed
+            root_xml_element = append_xml_fragment_to_elementtree_xml(
+                parent, tagged_string.encode('utf-8')
             )
         else:
             # Empty abstract
@@ -457,13 +450,9 @@ class pubMedPoaXML(object):
         doctype = ElifeDocumentType(qualifiedName)
         doctype._identified_mixin_init(publicId, systemId)
 
-        rough_string = ElementTree.tostring(self.root, encoding)
-        reparsed = minidom.parseString(rough_string)
-        if doctype:
-            reparsed.insertBefore(doctype, reparsed.documentElement)
-
-        #return reparsed.toprettyxml(indent="\t", encoding = encoding)
-        return reparsed.toxml(encoding=encoding)
+        stream = StringIO()
+        write_xml_document(stream, self.root, doctype, encoding)
+        return stream.getvalue()
 
 def build_pubmed_xml_for_articles(poa_articles):
     """
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+
+"""
+Memoization decorator shared by the XLS and CSV reading modules
+
+    @memoize
+    def get_xls_sheet(table_type):
+
+    @memoize(max_size=1000)
+    def get_article_attributes(article_id, attribute_type, attribute_label):
+
+With a max_size the least recently used values are discarded once the
+cache is full, without one the cache keeps every value.
+"""
+
+# every memoized function, so the cached values can all be cleared at once
+memoized_functions = []
+
+class Memoized():
+    """
+    A function with its cached return values keyed on its arguments,
+    counting cache hits and misses
+    """
+
+    def __init__(self, function, max_size=None):
+        self.function = function
+        self.max_size = max_size
+        self.__name__ = function.__name__
+        self.__doc__ = function.__doc__
+        self.hits = 0
+        self.misses = 0
+        if max_size is None:
+            self.cache = {}
+        else:
+            self.cache = OrderedDict()
+        memoized_functions.append(self)
+
+    def __call__(self, *args):
+        if self.max_size is None:
+            try:
+                value = self.cache[args]
+                self.hits += 1
+                return value
+            except KeyError:
+                pass
+        else:
+            try:
+                # Move the value to the most recently used end
+                value = self.cache.pop(args)
+                self.cache[args] = value
+                self.hits += 1
+                return value
+            except KeyError:
+                pass
+
+        self.misses += 1
+        value = self.function(*args)
+        self.cache[args] = value
+        if self.max_size is not None and len(self.cache) > self.max_size:
+            # Discard the least recently used value
+            self.cache.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self.cache)
+
+    def clear(self):
+        """
+        Discard the cached values, the hit and miss counts are kept
+        """
+        self.cache.clear()
+
+    def cache_info(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.cache),
+                "max_size": self.max_size}
+
+def memoize(function=None, max_size=None):
+    """
+    Memoization decorator for functions taking one or more arguments,
+    used as @memoize or @memoize(max_size=n)
+    """
+    if function is None:
+        def decorator(function):
+            return Memoized(function, max_size)
+        return decorator
+    return Memoized(function, max_size)
+
+def clear_memoized():
+    """
+    Clear the cached values of every memoized function,
+    for example when the data files are loaded again
+    """
+    for memoized_function in memoized_functions:
+        memoized_function.clear()
@@ -1,6 +1,15 @@
 
 import csv
-from collections import defaultdict
+import os
+import hashlib
+import cPickle
+import heapq
+import itertools
+import tempfile
+import sqlite3
+import time
+from collections import defaultdict, OrderedDict
+from memoize import memoize, clear_memoized, memoized_functions
 from generatePoaXml import *
 import settings as settings
 import re
@@ -59,26 +68,112 @@ COLUMN_HEADINGS = settings.XLS_COLUMN_HEADINGS
 
 OVERFLOW_XLS_FILES = settings.OVERFLOW_XLS_FILES
 
-def memoize(f):
-    """ Memoization decorator for functions taking one or more arguments. """
-    class memodict(dict):
-        def __init__(self, f):
-            self.f = f
-        def __call__(self, *args):
-            return self[args]
-        def __missing__(self, key):
-            ret = self[key] = self.f(*key)
-            return ret
-    return memodict(f)
-
-def entities(function):
+# set the directory for persistent parsed table snapshots, None to disable
+CSV_CACHE_DIR = settings.CSV_CACHE_DIR
+
+# the number of values kept by memoized lookups of single articles, None for no limit
+MEMOIZE_MAX_SIZE = settings.MEMOIZE_MAX_SIZE
+
+# set the SQLite database imported from the CSV files to read instead of the CSV files, or None
+CSV_DATABASE = settings.CSV_DATABASE
+
+# col names indexed together in each database table which has them
+DATABASE_INDEX_COL_NAMES = ['poa_m_ms_no', COLUMN_HEADINGS.get("author_id"),
+                            COLUMN_HEADINGS.get("funder_position")]
+
+# database table of the size, modification time and md5 of each CSV file when imported
+DATABASE_FILES_TABLE = "_csv_files"
+
+# number of rows sorted in memory at a time when streaming a CSV file not sorted on article_id
+SORT_CHUNK_SIZE = 100000
+
+# counts and timings of loading each table, for the summary at the end of a run
+xls_load_stats = {}
+
+# increment when a change to the parsing invalidates existing snapshots
+SNAPSHOT_VERSION = 3
+
+# the XLS_COLUMN_HEADINGS read from each table, checked when a table is loaded
+XLS_TABLE_COLUMNS = {
+    "authors": ["author_id", "author_position", "email", "author_type",
+                "dual_corresponding", "author_last_name", "author_first_name",
+                "author_middle_name", "author_institution", "author_department",
+                "author_city", "author_country", "author_state", "author_conflict",
+                "orcid"],
+    "license": ["license_id"],
+    "manuscript": ["doi", "articleType", "accepted_date", "editor_id",
+                   "editor_last_name", "editor_first_name", "editor_middle_name",
+                   "editor_institution", "editor_department", "editor_country",
+                   "funding_note"],
+    "received": ["received_date", "receipt_date"],
+    "subjects": ["subject_areas"],
+    "organisms": ["organisms"],
+    "abstract": ["abstract"],
+    "title": ["title"],
+    "keywords": ["keywords"],
+    "group_authors": ["group_author"],
+    "datasets": ["datasets"],
+    "funding": ["author_id", "award_id", "funder_position", "funder",
+                "funder_identifier"],
+    "ethics": ["ethics"]
+    }
+
+# how the cells of columns are decoded once when a table is loaded, by table and heading key
+# "entities" converts HTML entities to unicode, "cp1252" decodes CP-1252 encoded text
+XLS_COLUMN_DECODING = {
+    "authors": {"author_last_name": ["entities", "cp1252"],
+                "author_first_name": ["entities", "cp1252"],
+                "author_middle_name": ["entities", "cp1252"],
+                "author_institution": ["entities", "cp1252"],
+                "author_department": ["entities", "cp1252"],
+                "author_city": ["entities", "cp1252"],
+                "author_country": ["entities"]},
+    "manuscript": {"editor_last_name": ["entities", "cp1252"],
+                   "editor_first_name": ["entities", "cp1252"],
+                   "editor_middle_name": ["entities", "cp1252"],
+                   "editor_institution": ["entities"],
+                   "editor_department": ["entities"],
+                   "editor_country": ["entities"]},
+    "title": {"title": ["entities"]},
+    "abstract": {"abstract": ["entities", "cp1252"]},
+    "funding": {"funder": ["cp1252"]}
+    }
+
+def add_xls_load_stat(table_type, name, value):
+    table_stats = xls_load_stats.setdefault(table_type, {})
+    table_stats[name] = table_stats.get(name, 0) + value
+
+def get_xls_load_summary():
     """
-    Convert entities to unicode as a decorator
+    Lines summarising the tables loaded and the use of each memoized function
     """
-    def wrapper(*args, **kwargs):
-        value = function(*args, **kwargs)
-        return entity_to_unicode(value)
-    return wrapper
+    lines = []
+    for table_type in sorted(xls_load_stats.keys()):
+        table_stats = xls_load_stats[table_type]
+        line = "table " + table_type + ":"
+        if "parse_seconds" in table_stats:
+            line += (" %d bytes, %d rows parsed in %.3fs" %
+                     (table_stats.get("bytes", 0), table_stats.get("rows", 0),
+                      table_stats["parse_seconds"]))
+        if "decode_seconds" in table_stats:
+            line += ", decoded in %.3fs" % table_stats["decode_seconds"]
+        if "snapshot_seconds" in table_stats:
+            line += " snapshot loaded in %.3fs" % table_stats["snapshot_seconds"]
+        if "index_seconds" in table_stats:
+            line += ", indexed in %.3fs" % table_stats["index_seconds"]
+        lines.append(line)
+    for memoized_function in memoized_functions:
+        cache_info = memoized_function.cache_info()
+        calls = cache_info["hits"] + cache_info["misses"]
+        if calls == 0:
+            continue
+        lines.append("memoize %s: %d hits, %d misses, %.1f%% hit rate, %d cached" %
+                     (memoized_function.__name__, cache_info["hits"], cache_info["misses"],
+                      100.0 * cache_info["hits"] / calls, cache_info["size"]))
+    return lines
+
+def log_xls_load_summary():
+    logger.info("CSV load summary\n" + "\n".join(get_xls_load_summary()))
 
 def get_xls_path(path_type):
     """
@@ -92,47 +187,241 @@ def get_xls_path(path_type):
     return path
 
 ## general functions for getting data from the XLS file
-@memoize
-def get_xls_sheet(table_type):
-    logger.info("in get_xls_sheet")
+def parse_xls_sheet(table_type):
+    logger.info("in parse_xls_sheet")
     path = get_xls_path(table_type)
     logger.info(str(path))
-    csvreader = csv.reader(open(path, 'rb'), delimiter=',', quotechar='"')
-    sheet = []
-    for row in csvreader: sheet.append(row)
-    # For overflow file types, parse again with no quotechar
+    start_time = time.time()
+    with open(path, 'rb') as open_file:
+        sheet = list(iter_xls_rows(open_file, table_type))
+    add_xls_load_stat(table_type, "parse_seconds", time.time() - start_time)
+    add_xls_load_stat(table_type, "bytes", os.path.getsize(path))
+    add_xls_load_stat(table_type, "rows", len(sheet))
+    return sheet
+
+def iter_xls_rows(open_file, table_type):
+    """
+    Yield each row of an open CSV file, including the rows before DATA_START_ROW
+    """
     if table_type in OVERFLOW_XLS_FILES:
-        csvreader = csv.reader(open(path, 'rb'), delimiter=',', quotechar=None)
         if table_type == "ethics":
             join_cells_from = 3
         else:
             join_cells_from = 2
-        for row in csvreader:
-            if csvreader.line_num <= DATA_START_ROW:
-                continue
-            # Merge cells 3 to the end because any commas will cause extra columns
-            row[join_cells_from] = ','.join(row[join_cells_from:])
-            for index, cell in enumerate(row):
-                # Strip leading quotation marks
-                row[index] = cell.lstrip('"').rstrip('"')
-            try:
-                sheet[csvreader.line_num-1] = row
-            except IndexError:
-                # Last line may not exist so handle the error
-                pass
-    return sheet
+        return iter_overflow_csv(open_file, join_cells_from)
+    return csv.reader(open_file, delimiter=',', quotechar='"')
+
+def iter_overflow_csv(open_file, join_cells_from):
+    """
+    Overflow files allow quotation marks and commas in their final column,
+    so only the rows before DATA_START_ROW are parsed with a quotechar.
+    Data rows are parsed with no quotechar, the cells from join_cells_from
+    to the end are merged, and quotation marks stripped from each cell.
+    The file is read in a single pass.
+    """
+    csvreader = csv.reader(open_file, delimiter=',', quotechar='"')
+    for row in csvreader:
+        yield row
+        if csvreader.line_num >= DATA_START_ROW:
+            break
+    # Continue reading the same file from the first data row
+    csvreader = csv.reader(open_file, delimiter=',', quotechar=None)
+    for row in csvreader:
+        # Merge cells to the end because any commas will cause extra columns
+        row[join_cells_from] = ','.join(row[join_cells_from:])
+        for index, cell in enumerate(row):
+            # Strip leading quotation marks
+            row[index] = cell.lstrip('"').rstrip('"')
+        yield row
+
+def decode_xls_sheet(table_type, sheet):
+    """
+    Given a parsed sheet, return it with the cells of its data rows
+    decoded as set in XLS_COLUMN_DECODING
+    """
+    col_positions = compile_col_positions(table_type, sheet[ROWS_WITH_COLNAMES])
+    return sheet[:DATA_START_ROW] + decode_xls_rows(table_type, sheet[DATA_START_ROW:],
+                                                    col_positions)
+
+class UndecodedCell(str):
+    """
+    The original value of a cell which could not be decoded,
+    an article with one of these in its ArticleRecord fails to build
+    """
+    pass
+
+def decode_xls_cell(value, conversions):
+    decoded_value = value
+    try:
+        for conversion in conversions:
+            if conversion == "entities":
+                decoded_value = entity_to_unicode(decoded_value)
+            elif conversion == "cp1252":
+                decoded_value = decode_cp1252(decoded_value)
+    except UnicodeError:
+        logger.warning("could not decode " + repr(value))
+        return UndecodedCell(value)
+    return decoded_value
+
+def decode_xls_rows(table_type, rows, col_positions):
+    """
+    Return the rows with the cells of the table decoded as set in XLS_COLUMN_DECODING,
+    decoded rows are copies so the rows of the parsed sheet are unchanged
+    """
+    column_decoding = []
+    for heading_key, conversions in sorted(XLS_COLUMN_DECODING.get(table_type, {}).items()):
+        column_decoding.append((col_positions[COLUMN_HEADINGS[heading_key]], conversions))
+    if not column_decoding:
+        return rows
+    decoded_rows = []
+    for row in rows:
+        row = list(row)
+        for position, conversions in column_decoding:
+            # Short rows are left short
+            if position < len(row):
+                row[position] = decode_xls_cell(row[position], conversions)
+        decoded_rows.append(row)
+    return decoded_rows
+
+def get_file_signature(path):
+    """
+    Size and modification time of a file, a quick check for changes
+    """
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+def get_file_hash(path):
+    """
+    md5 hex digest of the file content
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as open_file:
+        for chunk in iter(lambda: open_file.read(65536), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def get_snapshot_path(table_type):
+    return os.path.join(CSV_CACHE_DIR, table_type + ".pickle")
+
+def get_snapshot_parse_options(table_type):
+    """
+    Settings which change the parsed content of a table, stored with
+    the snapshot so a change in settings also invalidates it
+    """
+    return (SNAPSHOT_VERSION, ROWS_WITH_COLNAMES, DATA_START_ROW,
+            table_type in OVERFLOW_XLS_FILES,
+            [(heading_key, COLUMN_HEADINGS[heading_key], conversions) for heading_key, conversions
+             in sorted(XLS_COLUMN_DECODING.get(table_type, {}).items())],
+            sorted(ENTITY_REPLACEMENTS.items()))
+
+def read_xls_snapshot(table_type, path):
+    """
+    Return the snapshot saved for the table if it still matches the CSV file,
+    otherwise None. The snapshot file holds a small header followed by the content,
+    so a stale snapshot is discarded without loading the content.
+    A snapshot is valid if the file size matches and either the modification time
+    or the content hash matches, in which case the header is refreshed.
+    """
+    snapshot_path = get_snapshot_path(table_type)
+    if not os.path.exists(snapshot_path):
+        return None
+    try:
+        with open(snapshot_path, 'rb') as open_file:
+            header = cPickle.load(open_file)
+            size, mtime = get_file_signature(path)
+            if (header.get("path") != path
+                    or header.get("parse_options") != get_snapshot_parse_options(table_type)
+                    or header.get("size") != size):
+                return None
+            if header.get("mtime") != mtime:
+                if header.get("hash") != get_file_hash(path):
+                    return None
+                # Content is unchanged, only touched, so keep the snapshot
+                refresh_header = True
+            else:
+                refresh_header = False
+            snapshot = cPickle.load(open_file)
+    except Exception:
+        logger.warning("could not read snapshot " + snapshot_path)
+        return None
+    if refresh_header:
+        header["mtime"] = mtime
+        write_xls_snapshot(table_type, header, snapshot)
+    logger.info("loaded snapshot for " + table_type)
+    return snapshot
+
+def write_xls_snapshot(table_type, header, snapshot):
+    """
+    Write the snapshot to a temporary file first and then rename it,
+    so an interrupted run never leaves a partial snapshot behind
+    """
+    snapshot_path = get_snapshot_path(table_type)
+    try:
+        if not os.path.exists(CSV_CACHE_DIR):
+            os.makedirs(CSV_CACHE_DIR)
+        temp_path = snapshot_path + "." + str(os.getpid()) + ".tmp"
+        with open(temp_path, 'wb') as open_file:
+            cPickle.dump(header, open_file, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(snapshot, open_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, snapshot_path)
+    except (IOError, OSError):
+        logger.warning("could not write snapshot " + snapshot_path)
+
+@memoize
+def get_xls_snapshot(table_type):
+    """
+    Return the parsed sheet of a table with its data rows decoded,
+    from the snapshot in CSV_CACHE_DIR if the CSV file is unchanged,
+    otherwise by parsing the CSV file and saving a new snapshot.
+    Each table has its own snapshot, so is invalidated independently.
+    """
+    path = get_xls_path(table_type)
+    if CSV_CACHE_DIR:
+        start_time = time.time()
+        snapshot = read_xls_snapshot(table_type, path)
+        if snapshot is not None:
+            add_xls_load_stat(table_type, "snapshot_seconds", time.time() - start_time)
+            return snapshot
+
+        # The file as it is before parsing, in case it is replaced while it is parsed
+        size, mtime = get_file_signature(path)
+        header = {"path": path,
+                  "parse_options": get_snapshot_parse_options(table_type),
+                  "size": size,
+                  "mtime": mtime,
+                  "hash": get_file_hash(path)}
+
+    sheet = parse_xls_sheet(table_type)
+    start_time = time.time()
+    snapshot = decode_xls_sheet(table_type, sheet)
+    add_xls_load_stat(table_type, "decode_seconds", time.time() - start_time)
+
+    if CSV_CACHE_DIR:
+        if get_file_signature(path) == (size, mtime):
+            write_xls_snapshot(table_type, header, snapshot)
+        else:
+            logger.warning(path + " changed while it was parsed, snapshot not written")
+    return snapshot
+
+def get_xls_sheet(table_type):
+    # get_xls_snapshot is memoized, the sheet is not cached again here
+    logger.info("in get_xls_sheet")
+    return get_xls_snapshot(table_type)
 
 @memoize
 def get_xls_col_names(table_type):
     logger.info("in get_xls_col_names")
     logger.info(table_type)
+    if CSV_DATABASE:
+        return get_database_col_names(table_type)
     sheet = get_xls_sheet(table_type)
-    logger.info(sheet)
-    logger.info(str(ROWS_WITH_COLNAMES))
+    # Logging every row is only done when debugging, it is slow for large files
+    log_rows = logger.isEnabledFor(logging.DEBUG)
+    if log_rows:
+        logger.debug(str(ROWS_WITH_COLNAMES))
     for index, row in enumerate(sheet):
-        logger.info("in enumerate")
-        logger.info(str(index) + " " + str(row))
-        logger.debug(str(index) + " " + str(ROWS_WITH_COLNAMES))
+        if log_rows:
+            logger.debug(str(index) + " " + str(row))
         if int(index) == int(ROWS_WITH_COLNAMES):
             return row
 
@@ -146,6 +435,72 @@ def get_xls_data_rows(table_type):
     return data_rows
 
 
+@memoize
+def get_xls_col_positions(table_type):
+    """
+    Compile a dict of the position of each column in the table, so a cell
+    is read by its offset instead of searching the col names for each value.
+    """
+    return compile_col_positions(table_type, get_xls_col_names(table_type))
+
+def compile_col_positions(table_type, col_names):
+    """
+    Raises ValueError if any of the XLS_TABLE_COLUMNS for the table are not
+    in XLS_COLUMN_HEADINGS or not in the col names
+    """
+    if col_names is None:
+        raise ValueError("no col names in " + get_xls_path(table_type))
+    col_positions = {}
+    for position, col_name in enumerate(col_names):
+        # Match list.index() by keeping the first position of a repeated col name
+        if col_name not in col_positions:
+            col_positions[col_name] = position
+
+    missing_headings = []
+    for heading_key in ['article_id'] + XLS_TABLE_COLUMNS.get(table_type, []):
+        if heading_key == 'article_id':
+            heading = 'poa_m_ms_no'
+        else:
+            heading = COLUMN_HEADINGS.get(heading_key)
+        if heading is None or heading not in col_positions:
+            missing_headings.append(heading_key + " (" + str(heading) + ")")
+    if missing_headings:
+        raise ValueError("missing col names in " + get_xls_path(table_type) + ": " +
+                         ", ".join(missing_headings))
+    return col_positions
+
+def load_xls_files(reload=False):
+    """
+    Load and check the col names of every table in XLS_FILES,
+    so a missing column fails before any articles are generated
+    With reload, all memoized values are cleared first so changed files are read again
+    """
+    if reload:
+        clear_memoized()
+    for table_type in sorted(XLS_FILES.keys()):
+        if CSV_DATABASE:
+            # Only check the col names, rows are read from the database when needed
+            get_xls_col_positions(table_type)
+        else:
+            index_table_on_article_id(table_type)
+
+def get_article_rows(table_type, article_id):
+    """
+    The data rows of a table for the article_id, queried from the
+    database if CSV_DATABASE is set, otherwise from the table index
+    """
+    if CSV_DATABASE:
+        return query_database_rows(table_type, [('poa_m_ms_no', str(article_id))])
+    return index_table_on_article_id(table_type).get(str(article_id), [])
+
+def get_article_ids(table_type):
+    """
+    The article_id of every article with rows in the table
+    """
+    if CSV_DATABASE:
+        return query_database_article_ids(table_type)
+    return index_table_on_article_id(table_type).keys()
+
 def get_cell_value(col_name, col_names, row):
     """
     we pass the name of the col and a copy of the col names row in to
@@ -165,21 +520,16 @@ def index_table_on_article_id(table_type):
     """
 
     logger.info("in index_table_on_article_id")
-    path = get_xls_path(table_type)
-
-    # get the data and the row of colnames
-    data_rows = get_xls_data_rows(table_type)
-    col_names = get_xls_col_names(table_type)
-
-    # logger.info("data_rows: " + str(data_rows))
-    logger.info("col_names: " + str(col_names))
-
+    sheet = get_xls_sheet(table_type)
+    # Check the col names are as expected when the table is first loaded
+    get_xls_col_positions(table_type)
+    start_time = time.time()
+    article_id_position = compile_col_positions(table_type,
+                                                sheet[ROWS_WITH_COLNAMES])['poa_m_ms_no']
     article_index = defaultdict(list)
-    for data_row in data_rows:
-        article_id = get_cell_value('poa_m_ms_no', col_names, data_row)
-        # author_id = get_cell_value("poa_a_id", col_names, data_row)
-        article_index[article_id].append(data_row)
-        # print article_id, author_id
+    for data_row in sheet[DATA_START_ROW:]:
+        article_index[data_row[article_id_position]].append(data_row)
+    add_xls_load_stat(table_type, "index_seconds", time.time() - start_time)
     return article_index
 
 @memoize
@@ -194,7 +544,7 @@ def index_authors_on_author_id():
     # so we are going to make a dict of dicts indexed on manuscript id and then author id
     # """
     table_type = "authors"
-    col_names = get_xls_col_names(table_type)
+    author_id_position = get_xls_col_positions(table_type)[COLUMN_HEADINGS["author_id"]]
     author_table = index_authors_on_article_id()
 
     article_ids = author_table.keys()
@@ -203,27 +553,23 @@ def index_authors_on_author_id():
         rows = author_table[article_id]
         author_index = defaultdict()
         for row in rows:
-            author_id = get_cell_value("poa_a_id", col_names, row)
+            author_id = row[author_id_position]
             author_index[author_id] = row
         article_author_index[article_id] = author_index
     return article_author_index
 
 ##functions for abstracting calls to specific data entries
-@memoize
+@memoize(max_size=MEMOIZE_MAX_SIZE)
 def get_article_attributes(article_id, attribute_type, attribute_label):
-    logger.info("in get_article_attributes")
-    logger.info("artilce_id: " + str(article_id) + " attribute_type: " +
-                attribute_type + " attribute_label:" +  attribute_label)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("in get_article_attributes artilce_id: " + str(article_id) +
+                     " attribute_type: " + attribute_type + " attribute_label:" +
+                     attribute_label)
     attributes = []
-    logger.info("about to generate attribute index")
-    attribute_index = index_table_on_article_id(attribute_type)
-    logger.info("generated attribute index")
-    # logger.info(str(attribute_index))
-    logger.info("about to get col_names for colname " + str(attribute_type))
-    col_names = get_xls_col_names(attribute_type)
-    attribute_rows = attribute_index[str(article_id)]
+    position = get_xls_col_positions(attribute_type)[attribute_label]
+    attribute_rows = get_article_rows(attribute_type, article_id)
     for attribute_row in attribute_rows:
-        attributes.append(get_cell_value(attribute_label, col_names, attribute_row))
+        attributes.append(attribute_row[position])
     return attributes
 
 # subjects table
@@ -256,14 +602,12 @@ def get_keywords(article_id):
 
 # manuscript table
 
-@entities
 def get_title(article_id):
     attributes = get_article_attributes(article_id, "title",
                                         COLUMN_HEADINGS["title"])
     attribute = attributes[0]
     return attribute
 
-@entities
 def get_abstract(article_id):
     attributes = get_article_attributes(article_id, "abstract",
                                         COLUMN_HEADINGS["abstract"])
@@ -300,37 +644,31 @@ def get_me_id(article_id):
                                        COLUMN_HEADINGS["editor_id"])[0]
     return attribute
 
-@entities
 def get_me_last_nm(article_id):
     attribute = get_article_attributes(article_id, "manuscript",
                                        COLUMN_HEADINGS["editor_last_name"])[0]
     return attribute
 
-@entities
 def get_me_first_nm(article_id):
     attribute = get_article_attributes(article_id, "manuscript",
                                        COLUMN_HEADINGS["editor_first_name"])[0]
     return attribute
 
-@entities
 def get_me_middle_nm(article_id):
     attribute = get_article_attributes(article_id, "manuscript",
                                        COLUMN_HEADINGS["editor_middle_name"])[0]
     return attribute
 
-@entities
 def get_me_institution(article_id):
     attribute = get_article_attributes(article_id, "manuscript",
                                        COLUMN_HEADINGS["editor_institution"])[0]
     return attribute
 
-@entities
 def get_me_department(article_id):
     attribute = get_article_attributes(article_id, "manuscript",
                                        COLUMN_HEADINGS["editor_department"])[0]
     return attribute
 
-@entities
 def get_me_country(article_id):
     attribute = get_article_attributes(article_id, "manuscript",
                                        COLUMN_HEADINGS["editor_country"])[0]
@@ -353,11 +691,16 @@ def get_author_ids(article_id):
                                         COLUMN_HEADINGS["author_id"])
     return author_ids
 
+def get_author_row(article_id, author_id):
+    if CSV_DATABASE:
+        # The last row for an author_id is used, as in index_authors_on_author_id
+        return query_database_rows("authors", [('poa_m_ms_no', str(article_id)),
+                                               (COLUMN_HEADINGS["author_id"], str(author_id))])[-1]
+    return index_authors_on_author_id()[article_id][author_id]
+
 def get_author_attribute(article_id, author_id, attribute_name):
-    article_author_index = index_authors_on_author_id()
-    data_row = article_author_index[article_id][author_id]
-    col_names = get_xls_col_names("authors")
-    attribute = get_cell_value(attribute_name, col_names, data_row)
+    data_row = get_author_row(article_id, author_id)
+    attribute = data_row[get_xls_col_positions("authors")[attribute_name]]
     return attribute
 
 def get_author_position(article_id, author_id):
@@ -380,43 +723,36 @@ def get_author_dual_corresponding(article_id, author_id):
                                      COLUMN_HEADINGS["dual_corresponding"])
     return attribute
 
-@entities
 def get_author_last_name(article_id, author_id):
     attribute = get_author_attribute(article_id, author_id,
                                      COLUMN_HEADINGS["author_last_name"])
     return attribute
 
-@entities
 def get_author_first_name(article_id, author_id):
     attribute = get_author_attribute(article_id, author_id,
                                      COLUMN_HEADINGS["author_first_name"])
     return attribute
 
-@entities
 def get_author_middle_name(article_id, author_id):
     attribute = get_author_attribute(article_id, author_id,
                                      COLUMN_HEADINGS["author_middle_name"])
     return attribute
 
-@entities
 def get_author_institution(article_id, author_id):
     attribute = get_author_attribute(article_id, author_id,
                                      COLUMN_HEADINGS["author_institution"])
     return attribute
 
-@entities
 def get_author_department(article_id, author_id):
     attribute = get_author_attribute(article_id, author_id,
                                      COLUMN_HEADINGS["author_department"])
     return attribute
 
-@entities
 def get_author_city(article_id, author_id):
     attribute = get_author_attribute(article_id, author_id,
                                      COLUMN_HEADINGS["author_city"])
     return attribute
 
-@entities
 def get_author_country(article_id, author_id):
     attribute = get_author_attribute(article_id, author_id,
                                      COLUMN_HEADINGS["author_country"])
@@ -465,31 +801,39 @@ def index_funding_table():
     table_type = "funding"
 
     logger.info("in index_funding_table")
-    path = get_xls_path(table_type)
 
-    # get the data and the row of colnames
-    data_rows = get_xls_data_rows(table_type)
-    col_names = get_xls_col_names(table_type)
+    # Index the rows of each article separately, from the table already indexed on article_id
+    article_index = {}
+    for article_id, data_rows in index_table_on_article_id(table_type).iteritems():
+        article_index[article_id] = index_funding_rows(data_rows)
+
+    #print article_index
+    return article_index
 
-    # logger.info("data_rows: " + str(data_rows))
-    logger.info("col_names: " + str(col_names))
+def index_funding_rows(data_rows):
+    """
+    Index the funding rows of one article on author_id and funder_position
+    """
+    col_positions = get_xls_col_positions("funding")
+    author_id_position = col_positions[COLUMN_HEADINGS["author_id"]]
+    funder_order_position = col_positions[COLUMN_HEADINGS["funder_position"]]
 
-    article_index = {}
+    author_index = {}
     for data_row in data_rows:
-        article_id = get_cell_value('poa_m_ms_no', col_names, data_row)
-        author_id = get_cell_value(COLUMN_HEADINGS["author_id"], col_names, data_row)
-        funder_position = get_cell_value(COLUMN_HEADINGS["funder_position"], col_names, data_row)
+        author_id = data_row[author_id_position]
+        funder_position = data_row[funder_order_position]
 
-        # Crude multidimentional dict builder
-        if article_id not in article_index:
-            article_index[article_id] = {}
-        if author_id not in article_index[article_id]:
-            article_index[article_id][author_id] = {}
+        if author_id not in author_index:
+            author_index[author_id] = {}
 
-        article_index[article_id][author_id][funder_position] = data_row
+        author_index[author_id][funder_position] = data_row
+    return author_index
 
-    #print article_index
-    return article_index
+def get_article_funding(article_id):
+    if CSV_DATABASE:
+        return index_funding_rows(get_article_rows("funding", article_id))
+    # The funding table is already indexed on article_id first
+    return index_funding_table().get(str(article_id), {})
 
 def get_funding_ids(article_id):
     """
@@ -498,21 +842,25 @@ def get_funding_ids(article_id):
     """
     funding_ids = []
 
-    for key, value in index_funding_table().iteritems():
-        if key == article_id:
-            for key_2, value_2 in value.iteritems():
-                for key_3, value_3 in value_2.iteritems():
-                    funding_ids.append((key, key_2, key_3))
+    article_funding = get_article_funding(article_id)
+    for author_id, author_funding in article_funding.iteritems():
+        for funder_position in author_funding.iterkeys():
+            funding_ids.append((str(article_id), author_id, funder_position))
 
     return funding_ids
 
-def get_funding_attribute(article_id, author_id, funder_position, attribute_name):
-    funding_article_index = index_funding_table()
+def get_funding_row(article_id, author_id, funder_position):
+    if CSV_DATABASE:
+        return query_database_rows("funding", [('poa_m_ms_no', str(article_id)),
+                                               (COLUMN_HEADINGS["author_id"], str(author_id)),
+                                               (COLUMN_HEADINGS["funder_position"],
+                                                str(funder_position))])[-1]
+    return index_funding_table()[str(article_id)][str(author_id)][str(funder_position)]
 
-    data_row = funding_article_index[str(article_id)][str(author_id)][str(funder_position)]
+def get_funding_attribute(article_id, author_id, funder_position, attribute_name):
+    data_row = get_funding_row(article_id, author_id, funder_position)
 
-    col_names = get_xls_col_names("funding")
-    attribute = get_cell_value(attribute_name, col_names, data_row)
+    attribute = data_row[get_xls_col_positions("funding")[attribute_name]]
     return attribute
 
 def get_funder(article_id, author_id, funder_position):
@@ -535,6 +883,494 @@ def get_funding_note(article_id):
                                        COLUMN_HEADINGS["funding_note"])[0]
     return attribute
 
+## article records
+
+# the XLS_TABLE_COLUMNS read as a list of all row values, others from the first row
+RECORD_LIST_COLUMNS = ["subject_areas", "organisms", "keywords"]
+
+class ArticleRecord():
+    """
+    The CSV data for one article, from all of the tables
+    Attributes are named after their XLS_COLUMN_HEADINGS key and are None
+    if the article has no row in the table
+    """
+    # manuscript table
+    doi = None
+    articleType = None
+    accepted_date = None
+    editor_id = None
+    editor_last_name = None
+    editor_first_name = None
+    editor_middle_name = None
+    editor_institution = None
+    editor_department = None
+    editor_country = None
+    funding_note = None
+    # other tables
+    received_date = None
+    receipt_date = None
+    license_id = None
+    abstract = None
+    title = None
+    group_author = None
+    datasets = None
+    ethics = None
+
+    def __init__(self, article_id):
+        self.article_id = article_id
+        # the tables which have rows for the article
+        self.table_types = []
+        # md5 of the rows of the article from every table, changes when any row changes
+        self.fingerprint = None
+        self.subject_areas = []
+        self.organisms = []
+        self.keywords = []
+        # AuthorRecord of each author, in the order of author_position
+        self.authors = []
+        # dicts of funding values, one per author_id and funder_position
+        self.funding = []
+        # table and heading key of each value which could not be decoded
+        self.undecoded_columns = []
+
+class AuthorRecord(object):
+    """
+    The values of one author row, attributes named after their XLS_COLUMN_HEADINGS key
+    Slots keep the records small for articles with hundreds of authors
+    """
+    __slots__ = tuple(XLS_TABLE_COLUMNS["authors"])
+
+    def __init__(self, row_values):
+        for heading_key in self.__slots__:
+            setattr(self, heading_key, row_values[heading_key])
+
+    def __eq__(self, other):
+        return (isinstance(other, AuthorRecord) and
+                all([getattr(self, key) == getattr(other, key) for key in self.__slots__]))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+def convert_record_value(heading_key, value):
+    """
+    Rows are already decoded when loaded, only funder names are cleaned
+    """
+    if heading_key == "funder":
+        value = clean_funder(value)
+    return value
+
+def read_record_values(table_type, article_id, rows, col_positions):
+    """
+    Read the XLS_TABLE_COLUMNS of each row into a dict keyed on heading key
+    Returns None if a row is too short,
+    the article then fails in the same way as when using the get_ functions
+    """
+    positions = []
+    for heading_key in XLS_TABLE_COLUMNS[table_type]:
+        positions.append((heading_key, col_positions[COLUMN_HEADINGS[heading_key]]))
+    values = []
+    try:
+        for row in rows:
+            row_values = {}
+            for heading_key, position in positions:
+                row_values[heading_key] = convert_record_value(heading_key, row[position])
+            values.append(row_values)
+    except IndexError:
+        logger.warning("could not read " + table_type + " rows for " + str(article_id))
+        return None
+    return values
+
+def add_attributes_to_record(record, table_type, values):
+    for heading_key in XLS_TABLE_COLUMNS[table_type]:
+        if heading_key in RECORD_LIST_COLUMNS:
+            if values is None:
+                setattr(record, heading_key, None)
+            else:
+                setattr(record, heading_key, [row_values[heading_key] for row_values in values])
+        elif values:
+            setattr(record, heading_key, values[0][heading_key])
+
+def add_authors_to_record(record, values):
+    """
+    One AuthorRecord per author_id, using the last row for the author_id,
+    sorted by author_position
+    """
+    if values is None:
+        record.authors = None
+        return
+    authors = OrderedDict()
+    for row_values in values:
+        author_id = row_values["author_id"]
+        if author_id in authors:
+            del authors[author_id]
+        authors[author_id] = AuthorRecord(row_values)
+    record.authors = authors.values()
+    try:
+        record.authors.sort(key=lambda author: int(author.author_position))
+    except ValueError:
+        # Left in table order, the article fails when its authors are added
+        logger.warning("author_position is not a number for " + str(record.article_id))
+
+def add_funding_to_record(record, values):
+    """
+    One funding row per author_id and funder_position, using the last row,
+    in the same order as get_funding_ids
+    """
+    if values is None:
+        record.funding = None
+        return
+    funding_index = {}
+    for row_values in values:
+        author_id = row_values["author_id"]
+        if author_id not in funding_index:
+            funding_index[author_id] = {}
+        funding_index[author_id][row_values["funder_position"]] = row_values
+    record.funding = []
+    for author_id, author_funding in funding_index.iteritems():
+        for funder_position, row_values in author_funding.iteritems():
+            record.funding.append(row_values)
+
+def add_rows_to_record(record, table_type, rows, col_positions):
+    record.table_types.append(table_type)
+    record.fingerprint = hashlib.md5(repr((record.fingerprint, table_type, rows))).hexdigest()
+    values = read_record_values(table_type, record.article_id, rows, col_positions)
+    for row_values in values or []:
+        for heading_key in XLS_TABLE_COLUMNS[table_type]:
+            column = table_type + " " + heading_key
+            if (isinstance(row_values[heading_key], UndecodedCell)
+                    and column not in record.undecoded_columns):
+                record.undecoded_columns.append(column)
+    if table_type == "authors":
+        add_authors_to_record(record, values)
+    elif table_type == "funding":
+        add_funding_to_record(record, values)
+    else:
+        add_attributes_to_record(record, table_type, values)
+
+@memoize
+def index_article_records():
+    """
+    Build the ArticleRecord of every article_id in the tables,
+    making one pass over the rows of each table in XLS_FILES
+    """
+    logger.info("in index_article_records")
+    records = {}
+    for table_type in sorted(XLS_FILES.keys()):
+        if table_type not in XLS_TABLE_COLUMNS:
+            continue
+        col_positions = get_xls_col_positions(table_type)
+        for article_id, rows in index_table_on_article_id(table_type).iteritems():
+            if article_id not in records:
+                records[article_id] = ArticleRecord(article_id)
+            add_rows_to_record(records[article_id], table_type, rows, col_positions)
+    return records
+
+def build_article_record(article_id):
+    """
+    Build the ArticleRecord of one article, from its rows of each table
+    """
+    record = ArticleRecord(article_id)
+    for table_type in sorted(XLS_FILES.keys()):
+        if table_type not in XLS_TABLE_COLUMNS:
+            continue
+        rows = get_article_rows(table_type, article_id)
+        if rows:
+            add_rows_to_record(record, table_type, rows, get_xls_col_positions(table_type))
+    return record
+
+def get_article_record(article_id):
+    """
+    Return the ArticleRecord for the article_id, an empty record if it is not in any table
+    With a CSV_DATABASE only the rows of this article are read
+    """
+    article_id = str(article_id)
+    if CSV_DATABASE:
+        return build_article_record(article_id)
+    records = index_article_records()
+    if article_id in records:
+        return records[article_id]
+    return ArticleRecord(article_id)
+
+## streaming the tables one article at a time
+
+def article_sort_key(article_id):
+    """
+    Order article_id values numerically, any that are not numbers after those that are
+    """
+    try:
+        return (0, int(article_id), article_id)
+    except ValueError:
+        return (1, 0, article_id)
+
+def read_xls_col_names(table_type):
+    """
+    Read the col names from the CSV file without reading the data rows
+    """
+    with open(get_xls_path(table_type), 'rb') as open_file:
+        for index, row in enumerate(iter_xls_rows(open_file, table_type)):
+            if index == ROWS_WITH_COLNAMES:
+                return row
+
+def iter_xls_data_rows(table_type):
+    with open(get_xls_path(table_type), 'rb') as open_file:
+        for index, row in enumerate(iter_xls_rows(open_file, table_type)):
+            if index >= DATA_START_ROW:
+                yield row
+
+def is_sorted_on_article_id(table_type, article_id_position):
+    last_key = None
+    for data_row in iter_xls_data_rows(table_type):
+        key = article_sort_key(data_row[article_id_position])
+        if last_key is not None and key < last_key:
+            return False
+        last_key = key
+    return True
+
+def write_sort_chunk(chunk):
+    """
+    Sort a chunk of (key, row number, row) and write it to a temporary file
+    """
+    chunk.sort()
+    chunk_file = tempfile.TemporaryFile()
+    for item in chunk:
+        cPickle.dump(item, chunk_file, cPickle.HIGHEST_PROTOCOL)
+    chunk_file.seek(0)
+    return chunk_file
+
+def read_sort_chunk(chunk_file):
+    while True:
+        try:
+            yield cPickle.load(chunk_file)
+        except EOFError:
+            return
+
+def iter_sorted_xls_data_rows(table_type, article_id_position):
+    """
+    Yield the data rows of a table in article_id order, keeping the order of the
+    rows of each article. If the CSV file is not already sorted, it is sorted once
+    with an external merge sort of SORT_CHUNK_SIZE rows at a time
+    """
+    if is_sorted_on_article_id(table_type, article_id_position):
+        for data_row in iter_xls_data_rows(table_type):
+            yield data_row
+        return
+
+    logger.info(table_type + " is not sorted on article_id, sorting it")
+    chunk_files = []
+    chunk = []
+    for row_number, data_row in enumerate(iter_xls_data_rows(table_type)):
+        chunk.append((article_sort_key(data_row[article_id_position]), row_number, data_row))
+        if len(chunk) >= SORT_CHUNK_SIZE:
+            chunk_files.append(write_sort_chunk(chunk))
+            chunk = []
+
+    if not chunk_files:
+        # Small enough to sort in memory
+        chunk.sort()
+        for key, row_number, data_row in chunk:
+            yield data_row
+        return
+
+    if chunk:
+        chunk_files.append(write_sort_chunk(chunk))
+    try:
+        for key, row_number, data_row in heapq.merge(*map(read_sort_chunk, chunk_files)):
+            yield data_row
+    finally:
+        for chunk_file in chunk_files:
+            chunk_file.close()
+
+def iter_xls_article_groups(table_type, col_positions):
+    """
+    Yield (sort key, article_id, table_type, rows) for each article_id in the table, in order
+    """
+    article_id_position = col_positions['poa_m_ms_no']
+    data_rows = iter_sorted_xls_data_rows(table_type, article_id_position)
+    for article_id, rows in itertools.groupby(data_rows, key=lambda row: row[article_id_position]):
+        yield (article_sort_key(article_id), article_id, table_type,
+               decode_xls_rows(table_type, list(rows), col_positions))
+
+def iter_article_records():
+    """
+    Yield the ArticleRecord of every article_id in the tables in article_id order,
+    reading all of the tables in XLS_FILES together so only the rows of
+    one article are held in memory at a time
+    """
+    logger.info("in iter_article_records")
+    col_positions = {}
+    table_groups = []
+    for table_type in sorted(XLS_FILES.keys()):
+        if table_type not in XLS_TABLE_COLUMNS:
+            continue
+        col_positions[table_type] = compile_col_positions(table_type,
+                                                          read_xls_col_names(table_type))
+        table_groups.append(iter_xls_article_groups(table_type, col_positions[table_type]))
+
+    article_groups = heapq.merge(*table_groups)
+    for (key, article_id), groups in itertools.groupby(article_groups, key=lambda group: group[:2]):
+        record = ArticleRecord(article_id)
+        for key, article_id, table_type, rows in groups:
+            add_rows_to_record(record, table_type, rows, col_positions[table_type])
+        yield record
+
+## SQLite database of the tables
+
+def database_column(position):
+    return "c" + str(position)
+
+@memoize
+def connect_database(database_path, process_id):
+    """
+    One connection for each process, a connection is not used after a fork
+    Values are returned as str, the same as from the csv module
+    """
+    connection = sqlite3.connect(database_path)
+    connection.text_factory = str
+    return connection
+
+def get_database_connection():
+    if not os.path.exists(CSV_DATABASE):
+        raise IOError("CSV_DATABASE " + CSV_DATABASE + " does not exist, import the CSV files first")
+    check_database_files(CSV_DATABASE)
+    return connect_database(CSV_DATABASE, os.getpid())
+
+@memoize
+def check_database_files(database_path):
+    """
+    Raise IOError if a CSV file has changed since it was imported into the database,
+    compared the same way as a snapshot, so a stale database is never read
+    A CSV file which is not there is not checked, the database is read instead
+    """
+    connection = connect_database(database_path, os.getpid())
+    try:
+        imported_files = dict([(table_type, (size, mtime, file_hash)) for
+                               table_type, size, mtime, file_hash in connection.execute(
+                                   'SELECT table_type, size, mtime, hash FROM "' +
+                                   DATABASE_FILES_TABLE + '"')])
+    except sqlite3.DatabaseError:
+        imported_files = {}
+    for table_type in sorted(XLS_FILES.keys()):
+        path = get_xls_path(table_type)
+        if not os.path.exists(path):
+            continue
+        size, mtime = get_file_signature(path)
+        imported_file = imported_files.get(table_type)
+        if (imported_file is None or imported_file[0] != size
+                or (imported_file[1] != mtime and imported_file[2] != get_file_hash(path))):
+            message = ("CSV_DATABASE " + database_path + " is out of date, " + path +
+                       " has changed since it was imported, import the CSV files again")
+            logger.error(message)
+            raise IOError(message)
+
+def import_xls_files_to_database(database_path):
+    """
+    Import every table in XLS_FILES into a new SQLite database, which
+    replaces any existing database at database_path once it is complete,
+    recording each CSV file so a change is found by check_database_files
+    """
+    if not database_path:
+        raise ValueError("CSV_DATABASE is not configured")
+    logger.info("importing CSV files to " + database_path)
+    temp_path = database_path + "." + str(os.getpid()) + ".tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = sqlite3.connect(temp_path)
+    connection.text_factory = str
+    try:
+        connection.execute('CREATE TABLE "' + DATABASE_FILES_TABLE + '" (table_type TEXT ' +
+                           'PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)')
+        for table_type in sorted(XLS_FILES.keys()):
+            import_xls_file_to_database(connection, table_type)
+        connection.commit()
+    finally:
+        connection.close()
+    os.rename(temp_path, database_path)
+    # Connections to a replaced database must be opened again
+    connect_database.clear()
+    check_database_files.clear()
+
+def import_xls_file_to_database(connection, table_type):
+    """
+    Each table has a row_number, the position of the row in the CSV file,
+    and a column c0, c1, ... for each cell, missing cells of short rows are NULL.
+    The poa_m_ms_no, author_id and funder_position col names are indexed.
+    """
+    path = get_xls_path(table_type)
+    # Record the file as it is before reading, a file changed while importing is then stale
+    size, mtime = get_file_signature(path)
+    connection.execute('INSERT INTO "' + DATABASE_FILES_TABLE + '" VALUES (?, ?, ?, ?)',
+                       [table_type, size, mtime, get_file_hash(path)])
+    # Read the file once for the col names and the width of the longest row
+    col_names = []
+    width = 0
+    with open(path, 'rb') as open_file:
+        for index, row in enumerate(iter_xls_rows(open_file, table_type)):
+            if index == ROWS_WITH_COLNAMES:
+                col_names = row
+            width = max(width, len(row))
+
+    columns = [database_column(position) for position in range(width)]
+    connection.execute('DROP TABLE IF EXISTS "' + table_type + '"')
+    connection.execute('CREATE TABLE "' + table_type + '" (row_number INTEGER PRIMARY KEY' +
+                       ''.join([', ' + column + ' TEXT' for column in columns]) + ')')
+
+    insert = ('INSERT INTO "' + table_type + '" VALUES (' +
+              ', '.join(['?'] * (width + 1)) + ')')
+    with open(path, 'rb') as open_file:
+        rows = iter_xls_rows(open_file, table_type)
+        connection.executemany(insert, ([row_number] + row + [None] * (width - len(row))
+                                        for row_number, row in enumerate(rows)))
+
+    index_columns = []
+    for col_name in DATABASE_INDEX_COL_NAMES:
+        if col_name in col_names:
+            index_columns.append(database_column(col_names.index(col_name)))
+    if index_columns:
+        connection.execute('CREATE INDEX "' + table_type + '_keys" ON "' + table_type + '" (' +
+                           ', '.join(index_columns) + ')')
+
+def database_row_to_list(database_row):
+    """
+    Convert a database row back to the CSV row, removing the row_number and
+    the NULL values added to the end of short rows
+    """
+    row = list(database_row[1:])
+    while row and row[-1] is None:
+        row.pop()
+    return row
+
+def get_database_col_names(table_type):
+    cursor = get_database_connection().execute(
+        'SELECT * FROM "' + table_type + '" WHERE row_number = ?', [ROWS_WITH_COLNAMES])
+    database_row = cursor.fetchone()
+    if database_row is None:
+        return None
+    return database_row_to_list(database_row)
+
+def query_database_rows(table_type, key_values):
+    """
+    The data rows of a table matching a list of (col name, value), in CSV order,
+    decoded as set in XLS_COLUMN_DECODING
+    """
+    col_positions = get_xls_col_positions(table_type)
+    conditions = ['row_number >= ?']
+    parameters = [DATA_START_ROW]
+    for col_name, value in key_values:
+        conditions.append(database_column(col_positions[col_name]) + ' = ?')
+        parameters.append(value)
+    cursor = get_database_connection().execute(
+        'SELECT * FROM "' + table_type + '" WHERE ' + ' AND '.join(conditions) +
+        ' ORDER BY row_number', parameters)
+    return decode_xls_rows(table_type,
+                           [database_row_to_list(database_row) for database_row in cursor],
+                           col_positions)
+
+def query_database_article_ids(table_type):
+    column = database_column(get_xls_col_positions(table_type)['poa_m_ms_no'])
+    cursor = get_database_connection().execute(
+        'SELECT DISTINCT ' + column + ' FROM "' + table_type + '" WHERE row_number >= ? AND ' +
+        column + ' IS NOT NULL', [DATA_START_ROW])
+    return [database_row[0] for database_row in cursor]
+
 ## conversion functions
 def get_elife_doi(article_id):
     """
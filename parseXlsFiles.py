@@ -1,6 +1,7 @@
 
 import xlrd
 from collections import defaultdict
+from memoize import memoize
 from generatePoaXml import *
 import settings as settings 
 import re
@@ -49,17 +50,8 @@ DATA_START_ROW = settings.DATA_START_ROW
 XLS_FILES = settings.XLS_FILES
 COLUMN_HEADINGS = settings.XLS_COLUMN_HEADINGS
 
-def memoize(f):
-    """ Memoization decorator for functions taking one or more arguments. """
-    class memodict(dict):
-        def __init__(self, f):
-            self.f = f
-        def __call__(self, *args):
-            return self[args]
-        def __missing__(self, key):
-            ret = self[key] = self.f(*key)
-            return ret
-    return memodict(f)
+# the number of values kept by memoized lookups of single articles
+MEMOIZE_MAX_SIZE = settings.MEMOIZE_MAX_SIZE
 
 def entities(function):
 	"""
@@ -163,7 +155,7 @@ def index_authors_on_author_id():
 	return article_author_index
 
 ##functions for abstracting calls to specific data entries 
-@memoize 
+@memoize(max_size=MEMOIZE_MAX_SIZE)
 def get_article_attributes(article_id, attribute_type, attribute_label):
 	attributes = []
 	attribute_index = index_table_on_article_id(attribute_type)
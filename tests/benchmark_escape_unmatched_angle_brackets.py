@@ -0,0 +1,35 @@
+"""
+Time escape_unmatched_angle_brackets on pathological inputs of increasing size,
+the time per character should stay about the same as the input grows
+
+    python tests/benchmark_escape_unmatched_angle_brackets.py
+"""
+import os
+import timeit
+
+os.sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generatePoaXml
+
+SIZES = [1000, 10000, 100000]
+
+# Repeated text for each kind of input, stray < as in statistics text,
+# unclosed < on separate lines, and one tag holding many <
+INPUTS = {
+    "statistics": lambda size: "<p>" + "p<0.05, n>3 <i>et al</i> " * (size / 25) + "</p>",
+    "lines": lambda size: "<\n" * (size / 2) + ">",
+    "nested": lambda size: "<" * size + "i>",
+}
+
+def benchmark(number=3):
+    for name in sorted(INPUTS):
+        for size in SIZES:
+            s = INPUTS[name](size)
+            seconds = min(timeit.repeat(
+                lambda: generatePoaXml.escape_unmatched_angle_brackets(s),
+                repeat=3, number=number)) / number
+            print "%-10s %8d characters %10.5fs %8.3fus per character" % (
+                name, len(s), seconds, seconds * 1000000 / len(s))
+
+if __name__ == '__main__':
+    benchmark()
@@ -9,6 +9,8 @@ DATA_START_ROW = 4
 
 XLS_PATH = TEST_BASE_PATH + "test_data" + os.sep
 
+CSV_CACHE_DIR = TEST_TEMP_DIR + "csv_cache"
+
 
 XLS_FILES = {
     "authors" : "poa_author.csv",
@@ -4,6 +4,10 @@ import os
 os.sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import generatePoaXml
+from xml.etree.ElementTree import Element, SubElement, Comment
+from xml.etree import ElementTree
+from xml.dom import minidom
+from StringIO import StringIO
 
 
 
@@ -23,6 +27,18 @@ class TestGeneratePoaXml(unittest.TestCase):
         self.passes.append(('<p>**p<0.01; ***p<0.001. SI, aged mice >5 months old.</p>',
                            '<p>**p&lt;0.01; ***p&lt;0.001. SI, aged mice &gt;5 months old.</p>'))
 
+        self.passes.append(('a <b\n> c <i>x</i>',
+                           'a &lt;b\n&gt; c <i>x</i>'))
+
+        self.passes.append(('<<sup>2</sup>',
+                           '&lt;<sup>2</sup>'))
+
+        self.passes.append(('p<0.05 and n>3 <sub>i</sub>',
+                           'p&lt;0.05 and n&gt;3 <sub>i</sub>'))
+
+        self.passes.append(('<i>a</i>>',
+                           '<i>a</i>&gt;'))
+
         for string_input, string_output in self.passes:
             self.assertEqual(generatePoaXml.escape_unmatched_angle_brackets(
                 string_input), string_output)
@@ -65,5 +81,82 @@ class TestGeneratePoaXml(unittest.TestCase):
             self.assertEqual(generatePoaXml.xml_escape_ampersand(
                 string_input), string_output)
 
+    def test_get_provenance(self):
+        saved_provenance = generatePoaXml.provenance
+        os.environ[generatePoaXml.VERSION_ENVIRONMENT_VARIABLE] = "1a2b3c4"
+        try:
+            generatePoaXml.provenance = None
+            provenance = generatePoaXml.get_provenance()
+            self.assertEqual(provenance["version"], "1a2b3c4")
+            # Resolved once for the process
+            os.environ[generatePoaXml.VERSION_ENVIRONMENT_VARIABLE] = "5d6e7f8"
+            self.assertTrue(generatePoaXml.get_provenance() is provenance)
+            comment = generatePoaXml.get_provenance_comment()
+            self.assertEqual(comment.text, "generated by eLife at " + provenance["generated"] +
+                             " from version 1a2b3c4")
+        finally:
+            del os.environ[generatePoaXml.VERSION_ENVIRONMENT_VARIABLE]
+            generatePoaXml.provenance = saved_provenance
+
+    def test_get_aff_id(self):
+        article = generatePoaXml.eLifePOA("10.7554/eLife.00003", "Title")
+        article_xml = generatePoaXml.eLife2XML(article)
+        affs = []
+        for department, institution, city in [("Biology", "UC Irvine", "Irvine"),
+                                              ("Physics", "UC Irvine", "Irvine"),
+                                              (None, "UC Irvine", ""),
+                                              ("Biology", "UC Irvine", "Irvine"),
+                                              ("Physics", None, None),
+                                              ("Physics", "USC", None)]:
+            aff = generatePoaXml.ContributorAffiliation()
+            aff.department = department
+            aff.institution = institution
+            aff.city = city
+            affs.append(aff)
+        # Missing values match any value, the last matching aff_id is used
+        self.assertEqual([article_xml.get_aff_id(aff) for aff in affs], [1, 2, 2, 1, 2, 3])
+        self.assertEqual(sorted(article_xml.author_affs.keys()), [1, 2, 3])
+
+    def test_append_xml_fragment_to_elementtree_xml(self):
+        xml = ('<jats:abstract xmlns:jats="http://www.ncbi.nlm.nih.gov/JATS1" abstract-type="e">' +
+               '<jats:p>A <i class="x">nested <b>bold</b></i> &amp; <sup>2</sup>\r\n' +
+               '\xce\xb1</jats:p></jats:abstract>')
+        attributes = ['abstract-type']
+
+        # The same as parsing with minidom and copying it into ElementTree
+        expected = Element('parent')
+        generatePoaXml.append_minidom_xml_to_elementtree_xml(
+            expected, minidom.parseString(xml), False, attributes)
+        parent = Element('parent')
+        self.assertTrue(generatePoaXml.append_xml_fragment_to_elementtree_xml(
+            parent, xml, attributes) is parent)
+        self.assertEqual(ElementTree.tostring(parent, 'utf-8'),
+                         ElementTree.tostring(expected, 'utf-8'))
+
+        self.assertRaises(ValueError, generatePoaXml.append_xml_fragment_to_elementtree_xml,
+                          Element('parent'), '<p>a<!--comment--></p>')
+
+    def test_write_xml_document(self):
+        root = Element('article')
+        root.set('xmlns:xlink', 'http://www.w3.org/1999/xlink')
+        root.append(Comment('generated'))
+        title = SubElement(root, 'title')
+        title.text = u'"Quoted" & <escaped> \u03b1\r\n'
+        italic = SubElement(title, 'italic', {'xlink:href': 'a\tb\nc', 'b': '"'})
+        italic.tail = 'tail'
+        SubElement(root, 'empty').text = ''
+        doctype = generatePoaXml.ElifeDocumentType('article')
+        doctype._identified_mixin_init('-//NLM//DTD JATS', 'JATS.dtd')
+
+        # The same as parsing the ElementTree XML with minidom
+        reparsed = minidom.parseString(ElementTree.tostring(root, 'utf-8'))
+        reparsed.insertBefore(doctype, reparsed.documentElement)
+        stream = StringIO()
+        generatePoaXml.write_xml_document(stream, root, doctype)
+        self.assertEqual(stream.getvalue(), reparsed.toxml(encoding='utf-8'))
+
+        root.text = u'\x0b'
+        self.assertRaises(ValueError, generatePoaXml.write_xml_document, StringIO(), root)
+
 if __name__ == '__main__':
     unittest.main()
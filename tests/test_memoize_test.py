@@ -0,0 +1,55 @@
+import unittest
+import os
+
+os.sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import memoize
+
+
+class TestMemoize(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.memoized_functions = list(memoize.memoized_functions)
+
+    def tearDown(self):
+        # Unregister the functions memoized by the test, the list is shared by reference
+        memoize.memoized_functions[:] = self.memoized_functions
+
+    def square(self, value):
+        self.calls.append(value)
+        return value * value
+
+    def test_memoize(self):
+        square = memoize.memoize(self.square)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(square(3), 9)
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(square.cache_info(),
+                         {"hits": 1, "misses": 1, "size": 1, "max_size": None})
+
+    def test_max_size(self):
+        square = memoize.memoize(max_size=2)(self.square)
+        square(1)
+        square(2)
+        # Using 1 makes 2 the least recently used value
+        square(1)
+        square(3)
+        self.assertEqual(len(square), 2)
+        square(1)
+        square(2)
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+        self.assertEqual(square.cache_info(),
+                         {"hits": 2, "misses": 4, "size": 2, "max_size": 2})
+
+    def test_clear_memoized(self):
+        square = memoize.memoize(self.square)
+        square(2)
+        memoize.clear_memoized()
+        self.assertEqual(len(square), 0)
+        square(2)
+        self.assertEqual(self.calls, [2, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
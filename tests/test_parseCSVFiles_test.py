@@ -0,0 +1,336 @@
+import unittest
+import os
+import csv
+import shutil
+import time
+
+os.sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import parseCSVFiles
+import memoize
+
+# Import test settings last in order to override the regular settings
+import poa_test_settings as settings
+
+
+def clear_memoized_tables():
+    memoize.clear_memoized()
+
+def parse_overflow_sheet_two_pass(path, join_cells_from):
+    """
+    The previous parsing of overflow files, reading the file twice,
+    to compare the single pass parsing against
+    """
+    csvreader = csv.reader(open(path, 'rb'), delimiter=',', quotechar='"')
+    sheet = []
+    for row in csvreader: sheet.append(row)
+    csvreader = csv.reader(open(path, 'rb'), delimiter=',', quotechar=None)
+    for row in csvreader:
+        if csvreader.line_num <= settings.DATA_START_ROW:
+            continue
+        row[join_cells_from] = ','.join(row[join_cells_from:])
+        for index, cell in enumerate(row):
+            row[index] = cell.lstrip('"').rstrip('"')
+        try:
+            sheet[csvreader.line_num-1] = row
+        except IndexError:
+            pass
+    return sheet
+
+
+class TestParseCSVFiles(unittest.TestCase):
+
+    def setUp(self):
+        # Work on a copy of the test data so the CSV files can be changed
+        self.xls_path = settings.TEST_TEMP_DIR + "csv_data" + os.sep
+        self.cache_dir = settings.CSV_CACHE_DIR
+        for path in [self.xls_path, self.cache_dir]:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        shutil.copytree(settings.XLS_PATH, self.xls_path)
+
+        self.original_xls_path = parseCSVFiles.XLS_PATH
+        self.original_cache_dir = parseCSVFiles.CSV_CACHE_DIR
+        self.original_database = parseCSVFiles.CSV_DATABASE
+        parseCSVFiles.XLS_PATH = self.xls_path
+        parseCSVFiles.CSV_CACHE_DIR = self.cache_dir
+        clear_memoized_tables()
+
+        self.parsed_tables = []
+        self.original_parse_xls_sheet = parseCSVFiles.parse_xls_sheet
+        def parse_xls_sheet(table_type):
+            self.parsed_tables.append(table_type)
+            return self.original_parse_xls_sheet(table_type)
+        parseCSVFiles.parse_xls_sheet = parse_xls_sheet
+
+    def tearDown(self):
+        parseCSVFiles.parse_xls_sheet = self.original_parse_xls_sheet
+        parseCSVFiles.XLS_PATH = self.original_xls_path
+        parseCSVFiles.CSV_CACHE_DIR = self.original_cache_dir
+        parseCSVFiles.CSV_DATABASE = self.original_database
+        clear_memoized_tables()
+        for path in [self.xls_path, self.cache_dir]:
+            shutil.rmtree(path, True)
+
+    def test_snapshot_reused(self):
+        index = parseCSVFiles.index_table_on_article_id("authors")
+        self.assertTrue(os.path.exists(self.cache_dir + os.sep + "authors.pickle"))
+        clear_memoized_tables()
+
+        # Touching the file without changing the content keeps the snapshot
+        path = parseCSVFiles.get_xls_path("authors")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(parseCSVFiles.index_table_on_article_id("authors"), index)
+        self.assertEqual(self.parsed_tables, ["authors"])
+
+    def test_snapshot_invalidated_per_table(self):
+        license_index = parseCSVFiles.index_table_on_article_id("license")
+        parseCSVFiles.index_table_on_article_id("received")
+        clear_memoized_tables()
+
+        path = parseCSVFiles.get_xls_path("license")
+        with open(path, 'ab') as open_file:
+            open_file.write('"99998","99998","2","2015-01-01 00:00:00.000"\n')
+
+        new_license_index = parseCSVFiles.index_table_on_article_id("license")
+        parseCSVFiles.index_table_on_article_id("received")
+        self.assertEqual(self.parsed_tables, ["license", "received", "license"])
+        self.assertEqual(new_license_index["99998"], [["99998", "99998", "2",
+                                                       "2015-01-01 00:00:00.000"]])
+        self.assertEqual(new_license_index["12"], license_index["12"])
+
+    def test_snapshot_not_written_when_changed(self):
+        path = parseCSVFiles.get_xls_path("license")
+        def parse_xls_sheet(table_type):
+            sheet = self.original_parse_xls_sheet(table_type)
+            # The file is replaced while it is parsed
+            with open(path, 'ab') as open_file:
+                open_file.write('"99998","99998","2","2015-01-01 00:00:00.000"\n')
+            return sheet
+        parseCSVFiles.parse_xls_sheet = parse_xls_sheet
+        self.assertFalse("99998" in parseCSVFiles.index_table_on_article_id("license"))
+        self.assertFalse(os.path.exists(self.cache_dir + os.sep + "license.pickle"))
+
+    def test_missing_col_name(self):
+        path = parseCSVFiles.get_xls_path("license")
+        with open(path, 'rb') as open_file:
+            content = open_file.read()
+        with open(path, 'wb') as open_file:
+            open_file.write(content.replace('"poa_l_license_id"', '"poa_l_license"'))
+        self.assertRaises(ValueError, parseCSVFiles.index_table_on_article_id, "license")
+        self.assertRaises(ValueError, parseCSVFiles.load_xls_files)
+
+    def test_article_record(self):
+        record = parseCSVFiles.get_article_record(3)
+        self.assertEqual(record.article_id, "3")
+        self.assertEqual(record.doi, parseCSVFiles.get_doi("3"))
+        self.assertEqual(record.title, parseCSVFiles.get_title("3"))
+        self.assertEqual(sorted([author.author_id for author in record.authors]),
+                         sorted(parseCSVFiles.get_author_ids("3")))
+        self.assertEqual([int(author.author_position) for author in record.authors],
+                         range(1, len(record.authors) + 1))
+        self.assertEqual(record.authors[3].author_id, "1249")
+        self.assertEqual(record.authors[3].author_institution,
+                         u"Institut d'Investigacions Biom\u00e8diques August Pi i Sunyer (IDIBAPS).")
+        # The group authors row is too short
+        self.assertEqual(record.group_author, None)
+        self.assertEqual(record.subject_areas, parseCSVFiles.get_subjects("3"))
+
+        record = parseCSVFiles.get_article_record(99999)
+        self.assertEqual(record.doi, None)
+        self.assertEqual(record.authors, [])
+
+    def test_get_funding_ids(self):
+        # Compare against scanning every row of the funding table
+        col_positions = parseCSVFiles.get_xls_col_positions("funding")
+        funding_ids = {}
+        for row in parseCSVFiles.get_xls_data_rows("funding"):
+            article_id = row[col_positions["poa_m_ms_no"]]
+            funding_id = (article_id,
+                          row[col_positions[parseCSVFiles.COLUMN_HEADINGS["author_id"]]],
+                          row[col_positions[parseCSVFiles.COLUMN_HEADINGS["funder_position"]]])
+            if funding_id not in funding_ids.setdefault(article_id, []):
+                funding_ids[article_id].append(funding_id)
+        self.assertTrue(len(funding_ids) > 0)
+        for article_id in funding_ids:
+            self.assertEqual(sorted(parseCSVFiles.get_funding_ids(article_id)),
+                             sorted(funding_ids[article_id]))
+        self.assertEqual(parseCSVFiles.get_funding_ids("99999"), [])
+
+    def assert_streamed_records(self):
+        records = parseCSVFiles.index_article_records()
+        streamed_article_ids = []
+        for record in parseCSVFiles.iter_article_records():
+            streamed_article_ids.append(record.article_id)
+            self.assertEqual(vars(record), vars(records[record.article_id]))
+        self.assertEqual(streamed_article_ids,
+                         sorted(records.keys(), key=parseCSVFiles.article_sort_key))
+
+    def test_iter_article_records(self):
+        self.assert_streamed_records()
+
+    def test_iter_article_records_unsorted(self):
+        # Reverse the data rows of the authors and funding files
+        for table_type in ["authors", "funding"]:
+            path = parseCSVFiles.get_xls_path(table_type)
+            with open(path, 'rb') as open_file:
+                lines = open_file.readlines()
+            with open(path, 'wb') as open_file:
+                open_file.writelines(lines[:settings.DATA_START_ROW] +
+                                     list(reversed(lines[settings.DATA_START_ROW:])))
+        original_sort_chunk_size = parseCSVFiles.SORT_CHUNK_SIZE
+        parseCSVFiles.SORT_CHUNK_SIZE = 5
+        try:
+            article_id_position = parseCSVFiles.get_xls_col_positions("authors")["poa_m_ms_no"]
+            data_rows = list(parseCSVFiles.iter_xls_data_rows("authors"))
+            self.assertFalse(parseCSVFiles.is_sorted_on_article_id("authors", article_id_position))
+            sorted_data_rows = list(parseCSVFiles.iter_sorted_xls_data_rows("authors",
+                                                                           article_id_position))
+            self.assertEqual(len(sorted_data_rows), len(data_rows))
+            self.assert_streamed_records()
+        finally:
+            parseCSVFiles.SORT_CHUNK_SIZE = original_sort_chunk_size
+
+    def test_database(self):
+        article_ids = parseCSVFiles.get_article_ids("manuscript")
+        records = parseCSVFiles.index_article_records()
+        funding_ids = dict([(article_id, parseCSVFiles.get_funding_ids(article_id))
+                            for article_id in article_ids])
+        emails = dict([(article_id, [parseCSVFiles.get_author_email(article_id, author_id)
+                                     for author_id in parseCSVFiles.get_author_ids(article_id)])
+                       for article_id in article_ids])
+
+        database_path = settings.TEST_TEMP_DIR + "csv.sqlite"
+        parseCSVFiles.import_xls_files_to_database(database_path)
+        clear_memoized_tables()
+        parseCSVFiles.CSV_DATABASE = database_path
+        self.parsed_tables = []
+        # Remove the CSV files to be sure only the database is used
+        for table_type in settings.XLS_FILES.keys():
+            os.remove(parseCSVFiles.get_xls_path(table_type))
+        try:
+            parseCSVFiles.load_xls_files()
+            self.assertEqual(sorted(parseCSVFiles.get_article_ids("manuscript")),
+                             sorted(article_ids))
+            for article_id in article_ids:
+                self.assertEqual(vars(parseCSVFiles.get_article_record(article_id)),
+                                 vars(records[article_id]))
+                self.assertEqual(parseCSVFiles.get_funding_ids(article_id),
+                                 funding_ids[article_id])
+                for (funding_article_id, author_id, funder_position) in funding_ids[article_id]:
+                    parseCSVFiles.get_funder(funding_article_id, author_id, funder_position)
+                self.assertEqual([parseCSVFiles.get_author_email(article_id, author_id)
+                                  for author_id in parseCSVFiles.get_author_ids(article_id)],
+                                 emails[article_id])
+            self.assertEqual(self.parsed_tables, [])
+        finally:
+            os.remove(database_path)
+
+    def test_database_out_of_date(self):
+        database_path = settings.TEST_TEMP_DIR + "csv.sqlite"
+        parseCSVFiles.import_xls_files_to_database(database_path)
+        parseCSVFiles.CSV_DATABASE = database_path
+        try:
+            # Touching a file without changing the content keeps the database
+            path = parseCSVFiles.get_xls_path("license")
+            os.utime(path, (time.time() + 10, time.time() + 10))
+            parseCSVFiles.load_xls_files()
+
+            clear_memoized_tables()
+            with open(path, 'ab') as open_file:
+                open_file.write('"99998","99998","2","2015-01-01 00:00:00.000"\n')
+            self.assertRaises(IOError, parseCSVFiles.load_xls_files)
+            self.assertRaises(IOError, parseCSVFiles.get_article_record, "12")
+
+            parseCSVFiles.import_xls_files_to_database(database_path)
+            self.assertEqual(parseCSVFiles.get_article_ids("license").count("99998"), 1)
+        finally:
+            os.remove(database_path)
+
+    def test_database_not_configured(self):
+        self.assertRaises(ValueError, parseCSVFiles.import_xls_files_to_database, None)
+
+    def test_load_summary(self):
+        parseCSVFiles.xls_load_stats.clear()
+        parseCSVFiles.index_table_on_article_id("license")
+        hits = parseCSVFiles.get_article_attributes.cache_info()["hits"]
+        parseCSVFiles.get_license("12")
+        parseCSVFiles.get_license("12")
+        self.assertEqual(parseCSVFiles.get_article_attributes.cache_info()["hits"], hits + 1)
+        stats = parseCSVFiles.xls_load_stats["license"]
+        self.assertEqual(stats["bytes"], os.path.getsize(parseCSVFiles.get_xls_path("license")))
+        self.assertEqual(stats["rows"], len(parseCSVFiles.get_xls_sheet("license")))
+        self.assertTrue("decode_seconds" in stats)
+        self.assertTrue("index_seconds" in stats)
+
+        summary = parseCSVFiles.get_xls_load_summary()
+        self.assertTrue(summary[0].startswith("table license: %d bytes" % stats["bytes"]))
+        self.assertTrue([line for line in summary
+                         if line.startswith("memoize get_article_attributes: ")])
+
+        clear_memoized_tables()
+        parseCSVFiles.xls_load_stats.clear()
+        parseCSVFiles.index_table_on_article_id("license")
+        self.assertTrue("snapshot_seconds" in parseCSVFiles.xls_load_stats["license"])
+
+    def test_decoded_when_loaded(self):
+        institution = u"Institut d'Investigacions Biom\u00e8diques August Pi i Sunyer (IDIBAPS)."
+        self.assertEqual(parseCSVFiles.get_author_institution("3", "1249"), institution)
+        # Only the decoded rows are kept, the index is built from them
+        cells = [cell for row in parseCSVFiles.get_xls_sheet("authors") for cell in row]
+        self.assertTrue(institution in cells)
+        self.assertFalse("Institut d'Investigacions Biom&#x00E8;diques August Pi i Sunyer (IDIBAPS)."
+                         in cells)
+        self.assertTrue(parseCSVFiles.index_table_on_article_id("authors")["3"][0]
+                        in parseCSVFiles.get_xls_sheet("authors"))
+
+    def test_snapshot_invalidated_by_entity_replacements(self):
+        self.assertTrue("&amp;" in parseCSVFiles.get_abstract("3"))
+        clear_memoized_tables()
+
+        parseCSVFiles.ENTITY_REPLACEMENTS["amp"] = u"&"
+        parseCSVFiles.compile_entity_pattern()
+        try:
+            abstract = parseCSVFiles.get_abstract("3")
+        finally:
+            del parseCSVFiles.ENTITY_REPLACEMENTS["amp"]
+            parseCSVFiles.compile_entity_pattern()
+        self.assertFalse("&amp;" in abstract)
+        self.assertTrue(" & " in abstract)
+        self.assertEqual(self.parsed_tables, ["abstract", "abstract"])
+
+    def test_snapshot_invalidated_by_column_headings(self):
+        parseCSVFiles.index_table_on_article_id("authors")
+        clear_memoized_tables()
+
+        original_col_name = parseCSVFiles.COLUMN_HEADINGS["author_country"]
+        parseCSVFiles.COLUMN_HEADINGS["author_country"] = "poa_a_state"
+        try:
+            parseCSVFiles.index_table_on_article_id("authors")
+        finally:
+            parseCSVFiles.COLUMN_HEADINGS["author_country"] = original_col_name
+        self.assertEqual(self.parsed_tables, ["authors", "authors"])
+
+    def test_undecoded_cell(self):
+        value = parseCSVFiles.decode_xls_cell("M\xfcller &#x00E8;", ["entities", "cp1252"])
+        self.assertTrue(isinstance(value, parseCSVFiles.UndecodedCell))
+        self.assertEqual(value, "M\xfcller &#x00E8;")
+
+        path = parseCSVFiles.get_xls_path("authors")
+        with open(path, 'rb') as open_file:
+            content = open_file.read()
+        with open(path, 'wb') as open_file:
+            open_file.write(content.replace("Biom&#x00E8;diques", "Biom\xe8diques &#x00E8;"))
+        record = parseCSVFiles.get_article_record(3)
+        self.assertEqual(record.undecoded_columns, ["authors author_institution"])
+        self.assertEqual(parseCSVFiles.get_article_record(7).undecoded_columns, [])
+
+    def test_parse_overflow_csv(self):
+        for table_type, join_cells_from in [("abstract", 2), ("title", 2), ("ethics", 3)]:
+            path = parseCSVFiles.get_xls_path(table_type)
+            self.assertEqual(parseCSVFiles.parse_xls_sheet(table_type),
+                             parse_overflow_sheet_two_pass(path, join_cells_from))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -108,5 +108,130 @@ class TestXmlGeneration(unittest.TestCase):
             compare_to_xml = self.read_uncommented_xml(settings.XLS_PATH + xml_file_name)
             self.assertEqual(generated_xml, compare_to_xml)
 
+    def test_build_xml_for_records_ledger(self):
+        records = [get_article_record(3), get_article_record(7)]
+        ledger = {}
+        build_xml_for_records(records, ledger)
+        self.assertEqual(ledger, {"3": records[0].fingerprint, "7": records[1].fingerprint})
+        self.assertNotEqual(records[0].fingerprint, records[1].fingerprint)
+
+        ledger_path = settings.TEST_TEMP_DIR + "ledger.json"
+        write_fingerprint_ledger(ledger_path, ledger)
+        ledger = read_fingerprint_ledger(ledger_path)
+        os.remove(ledger_path)
+        self.assertFalse(is_article_changed(records[0], ledger))
+
+        # Changed rows or a missing XML file are generated again
+        ledger["3"] = "changed"
+        self.assertTrue(is_article_changed(records[0], ledger))
+        os.remove(settings.TARGET_OUTPUT_DIR + os.sep + get_xml_file_name(7))
+        self.assertTrue(is_article_changed(records[1], ledger))
+
+    def test_build_xml_for_records_workers(self):
+        records = [get_article_record(article_id) for (article_id, xml_file_name) in self.passes]
+        records.append(get_article_record(99999))
+        for (article_id, xml_file_name) in self.passes:
+            xml_file = settings.TARGET_OUTPUT_DIR + os.sep + xml_file_name
+            if os.path.exists(xml_file):
+                os.remove(xml_file)
+        summary = build_xml_for_records(records, workers=2)
+        self.assertEqual(summary["generated"],
+                         [str(article_id) for (article_id, xml_file_name) in self.passes])
+        self.assertEqual(summary["failed"], ["99999"])
+        for (article_id, xml_file_name) in self.passes:
+            self.assertTrue(os.path.exists(settings.TARGET_OUTPUT_DIR + os.sep + xml_file_name))
+
+    def test_build_xml_for_articles(self):
+        results = build_xml_for_articles([3, 99999])
+        self.assertEqual([result["article_id"] for result in results], ["3", "99999"])
+        self.assertTrue(results[0]["success"])
+        self.assertEqual(results[0]["failed_functions"], [])
+        self.assertTrue(results[0]["build_seconds"] >= 0)
+        self.assertTrue(results[0]["serialize_seconds"] >= 0)
+        self.assertTrue(results[0]["write_seconds"] >= 0)
+        self.assertFalse(results[1]["success"])
+        self.assertTrue("set_title" in results[1]["failed_functions"])
+        self.assertEqual(results[1]["serialize_seconds"], None)
+        self.assertEqual(results[1]["write_seconds"], None)
+
+    def test_xml_writer(self):
+        article, failed_functions = build_article_for_record(get_article_record(3))
+        article_xml = eLife2XML(article)
+        writer = XmlWriter(queue_size=1)
+        writer.write(3, article_xml, dir=settings.TARGET_OUTPUT_DIR)
+        writer.write(7, article_xml, dir=settings.TEST_TEMP_DIR + "missing")
+        self.assertEqual(writer.close(), ["7"])
+        self.assertEqual(writer.file_count, 1)
+        xml_file = settings.TARGET_OUTPUT_DIR + os.sep + get_xml_file_name(3)
+        with open(xml_file, 'rb') as open_file:
+            self.assertEqual(open_file.read(), article_xml.prettyXML())
+        self.assertEqual([file_name for file_name in os.listdir(settings.TARGET_OUTPUT_DIR)
+                          if file_name.endswith(".tmp")], [])
+
+    def test_write_xml_skip_unchanged(self):
+        xml_file = settings.TARGET_OUTPUT_DIR + os.sep + "skip_unchanged.xml"
+        xml_string = '<?xml version="1.0"?><!--generated by eLife at 2016-01-01 from version abc--><article/>'
+        self.assertTrue(write_xml_file(xml_file, xml_string, skip_unchanged=True))
+        regenerated_xml_string = xml_string.replace("2016-01-01", "2016-01-02")
+        self.assertFalse(write_xml_file(xml_file, regenerated_xml_string, skip_unchanged=True))
+        self.assertTrue(write_xml_file(xml_file, regenerated_xml_string))
+        changed_xml_string = regenerated_xml_string.replace("<article/>", "<article></article>")
+        self.assertTrue(write_xml_file(xml_file, changed_xml_string, skip_unchanged=True))
+        with open(xml_file, 'rb') as open_file:
+            self.assertEqual(open_file.read(), changed_xml_string)
+
+    def test_validate_records(self):
+        records = [get_article_record(3), get_article_record(99999)]
+        xml_file = settings.TARGET_OUTPUT_DIR + os.sep + get_xml_file_name(3)
+        if os.path.exists(xml_file):
+            os.remove(xml_file)
+        for workers in [1, 2]:
+            results = validate_records(records, workers)
+            self.assertEqual(results[0], ("3", []))
+            self.assertEqual(results[1][0], "99999")
+            self.assertEqual(results[1][1][0], "instantiate_article")
+            self.assertTrue("set_title" in results[1][1])
+        self.assertFalse(os.path.exists(xml_file))
+
+    def test_map_shared_records(self):
+        records = [get_article_record(3), get_article_record(99999)]
+        # The worker processes read a list of records from their forked copy, unpickled
+        records[0].unpicklable = lambda: None
+        results = list(map_records(validate_record, records, workers=2))
+        self.assertEqual(results[0], ("3", []))
+        self.assertEqual(results[1][0], "99999")
+        self.assertEqual(xml_generation.shared_records, {})
+
+        del records[0].unpicklable
+        self.assertEqual(list(map_records(validate_record, iter(records), workers=2)), results)
+
+    def test_build_xml_for_article_ids_database(self):
+        records = [get_article_record(3), get_article_record(99999)]
+        database_path = settings.TEST_TEMP_DIR + "csv.sqlite"
+        import_xls_files_to_database(database_path)
+        original_database = parseCSVFiles.CSV_DATABASE
+        parseCSVFiles.CSV_DATABASE = database_path
+        try:
+            ledger = {}
+            summary = build_xml_for_article_ids(["3", "99999"], ledger, workers=2)
+            self.assertEqual(summary["generated"], ["3"])
+            self.assertEqual(summary["failed"], ["99999"])
+            self.assertEqual(ledger, {"3": records[0].fingerprint})
+            summary = build_xml_for_article_ids(["3"], ledger, workers=2)
+            self.assertEqual(summary["unchanged"], ["3"])
+            self.assertEqual(validate_article_ids(["3", "99999"], workers=2),
+                             validate_records(records))
+        finally:
+            parseCSVFiles.CSV_DATABASE = original_database
+            os.remove(database_path)
+
+    def test_validate_undecoded_record(self):
+        record = get_article_record(3)
+        record.undecoded_columns.append("authors author_institution")
+        self.assertEqual(validate_records([record]), [("3", ["decode_xls_cell"])])
+        result = build_xml_result(3, record)
+        self.assertFalse(result["success"])
+        self.assertEqual(result["output"], None)
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,6 +4,15 @@ import xlrd
 import settings as settings
 import logging
 import os
+import argparse
+import json
+import hashlib
+import re
+import itertools
+import multiprocessing
+import threading
+import Queue
+import time
 
 """
 read from an xls file
@@ -27,44 +36,44 @@ logger.addHandler(hdlr)
 logger.setLevel(logging.INFO)
 
 
-def instantiate_article(article_id):
-    logger.info("in instantiate_article for " + str(article_id))
+def instantiate_article(record):
+    logger.info("in instantiate_article for " + str(record.article_id))
     try:
-        doi = get_doi(article_id)
+        doi = record.doi
         # Fallback if doi string is blank, default to eLife concatenated
         if doi.strip() == "":
-            doi = get_elife_doi(article_id)
+            doi = get_elife_doi(record.article_id)
         #title = get_title(article_id)
         article = eLifePOA(doi, title=None)
         return article
     except:
         logger.error("could not create article class")
 
-def set_title(article, article_id):
+def set_title(article, record):
     logger.info("in set_title")
     try:
-        title = get_title(article_id)
+        title = record.title
         article.title = convert_to_xml_string(title)
         return True
     except:
         logger.error("could not set title ")
         return False
 
-def set_abstract(article, article_id):
+def set_abstract(article, record):
     logger.info("in set_abstract")
     try:
-        abstract = decode_cp1252(get_abstract(article_id))
+        abstract = record.abstract
         article.abstract = convert_to_xml_string(abstract)
-        article.manuscript = article_id
+        article.manuscript = record.article_id
         return True
     except:
         logger.error("could not set abstract ")
         return False
 
-def set_articleType(article, article_id):
+def set_articleType(article, record):
     logger.info("in set_articleType")
     try:
-        articleType_id = get_articleType(article_id)
+        articleType_id = record.articleType
 
         # Boilerplate article-type values based on id in CSV file
         article_type_index = {}
@@ -93,10 +102,12 @@ def set_articleType(article, article_id):
         logger.error("could not set articleType")
         return False
 
-def set_license(article, article_id):
+def set_license(article, record):
     logger.info("in set_license")
     try:
-        license_id = get_license(article_id)
+        license_id = record.license_id
+        if license_id is None:
+            raise ValueError("no license")
         license = eLifeLicense(license_id)
         article.license = license
         return True
@@ -104,19 +115,19 @@ def set_license(article, article_id):
         logger.error("could not set license")
         return False
 
-def set_dates(article, article_id):
+def set_dates(article, record):
     logger.info("in set_dates")
     try:
-        accepted_date = get_accepted_date(article_id)
+        accepted_date = record.accepted_date
         t_accepted = time.strptime(accepted_date.split()[0], "%Y-%m-%d")
         accepted = eLifeDate("accepted", t_accepted)
         article.add_date(accepted)
         logger.info(str(accepted_date))
 
-        received_date = get_received_date(article_id)
+        received_date = record.received_date
         if received_date.strip() == "":
             # Use the alternate date column receipt_date if received_date is blank
-            received_date = get_receipt_date(article_id)
+            received_date = record.receipt_date
         t_received = time.strptime(received_date.split()[0], "%Y-%m-%d")
         received = eLifeDate("received", t_received)
         article.add_date(received)
@@ -129,10 +140,10 @@ def set_dates(article, article_id):
         logger.error("could not set dates")
         return False
 
-def set_ethics(article, article_id):
+def set_ethics(article, record):
     logger.info("in set_ethics")
     try:
-        ethic = get_ethics(article_id)
+        ethic = record.ethics
         logger.info(ethic)
         if ethic:
             ethics = parse_ethics(ethic)
@@ -144,10 +155,10 @@ def set_ethics(article, article_id):
         return False
 
 
-def set_datasets(article, article_id):
+def set_datasets(article, record):
     logger.info("in set_datasets")
     try:
-        datasets = get_datasets(article_id)
+        datasets = record.datasets
         logger.info(datasets)
         if datasets:
             dataset_objects = parse_datasets(datasets)
@@ -158,10 +169,10 @@ def set_datasets(article, article_id):
         logger.error("could not set datasets")
         return False
 
-def set_categories(article, article_id):
+def set_categories(article, record):
     logger.info("in set_categories")
     try:
-        categories = get_subjects(article_id)
+        categories = record.subject_areas
         for category in categories:
             article.add_article_category(category)
         return True
@@ -169,10 +180,10 @@ def set_categories(article, article_id):
         logger.error("could not set categories")
         return False
 
-def set_organsims(article, article_id):
+def set_organsims(article, record):
     logger.info("in set_categories")
     try:
-        research_organisms = get_organisms(article_id)
+        research_organisms = record.organisms
         for research_organism in research_organisms:
             if research_organism.strip() != "":
                 article.add_research_organism(research_organism)
@@ -181,10 +192,10 @@ def set_organsims(article, article_id):
         logger.error("could not set organisms")
         return False
 
-def set_keywords(article, article_id):
+def set_keywords(article, record):
     logger.info("in set_keywords")
     try:
-        keywords = get_keywords(article_id)
+        keywords = record.keywords
         for keyword in keywords:
             article.add_author_keyword(keyword)
         return True
@@ -192,7 +203,7 @@ def set_keywords(article, article_id):
         logger.error("could not set keywords")
         return False
 
-def set_author_info(article, article_id):
+def set_author_info(article, record):
     """
     author information
     Save the contributor and their position in the list in a dict,
@@ -202,14 +213,13 @@ def set_author_info(article, article_id):
     logger.info("in set_author_info")
     authors_dict = {}
     try:
-        author_ids = get_author_ids(article_id)
-        for author_id in author_ids:
+        for author_record in record.authors:
 
             author_type = "author"
 
-            first_name = decode_cp1252(get_author_first_name(article_id, author_id))
-            last_name = decode_cp1252(get_author_last_name(article_id, author_id))
-            middle_name = decode_cp1252(get_author_middle_name(article_id, author_id))
+            first_name = author_record.author_first_name
+            last_name = author_record.author_last_name
+            middle_name = author_record.author_middle_name
             #initials = middle_name_initials(middle_name)
             if middle_name.strip() != "":
                 # Middle name add to the first name / given name
@@ -217,40 +227,39 @@ def set_author_info(article, article_id):
             author = eLifePOSContributor(author_type, last_name, first_name)
             affiliation = ContributorAffiliation()
 
-            department = decode_cp1252(get_author_department(article_id, author_id))
+            department = author_record.author_department
             if department.strip() != "":
                 affiliation.department = department
-            affiliation.institution = decode_cp1252(get_author_institution(article_id, author_id))
-            city = decode_cp1252(get_author_city(article_id, author_id))
+            affiliation.institution = author_record.author_institution
+            city = author_record.author_city
             if city.strip() != "":
                 affiliation.city = city
-            affiliation.country = get_author_country(article_id, author_id)
+            affiliation.country = author_record.author_country
 
-            contrib_type = get_author_contrib_type(article_id, author_id)
-            dual_corresponding = get_author_dual_corresponding(article_id, author_id)
+            contrib_type = author_record.author_type
+            dual_corresponding = author_record.dual_corresponding
             if (contrib_type == "Corresponding Author" or
                     (dual_corresponding.strip() != '' and int(dual_corresponding.strip()) == 1)):
-                email = get_author_email(article_id, author_id)
-                affiliation.email = get_author_email(article_id, author_id)
+                affiliation.email = author_record.email
                 author.corresp = True
 
-            conflict = get_author_conflict(article_id, author_id)
+            conflict = author_record.author_conflict
             if conflict.strip() != "":
                 author.set_conflict(conflict)
 
-            orcid = get_author_orcid(article_id, author_id)
+            orcid = author_record.orcid
             if orcid.strip() != "":
                 author.orcid = orcid
 
-            author.auth_id = `int(author_id)`
+            author.auth_id = `int(author_record.author_id)`
             author.set_affiliation(affiliation)
 
-            author_position = get_author_position(article_id, author_id)
+            author_position = author_record.author_position
             # Add the author to the dictionary recording their position in the list
             authors_dict[int(author_position)] = author
 
         # Add group author collab contributors, if present
-        group_authors = get_group_authors(article_id)
+        group_authors = record.group_author
         if group_authors:
             # Parse the group authors string
             group_author_dict = parse_group_authors(group_authors)
@@ -278,14 +287,14 @@ def set_author_info(article, article_id):
         logger.error("could not set authors")
         return False
 
-def set_editor_info(article, article_id):
+def set_editor_info(article, record):
     logger.info("in set_editor_info")
     try:
         author_type = "editor"
 
-        first_name = decode_cp1252(get_me_first_nm(article_id))
-        last_name = decode_cp1252(get_me_last_nm(article_id))
-        middle_name = decode_cp1252(get_me_middle_nm(article_id))
+        first_name = record.editor_first_name
+        last_name = record.editor_last_name
+        middle_name = record.editor_middle_name
         #initials = middle_name_initials(middle_name)
         if middle_name.strip() != "":
             # Middle name add to the first name / given name
@@ -293,16 +302,14 @@ def set_editor_info(article, article_id):
         # create an instance of the POSContributor class
         editor = eLifePOSContributor(author_type, last_name, first_name)
         logger.info("editor is: " + str(editor))
-        logger.info("getting ed id for article " + str(article_id))
-        logger.info("editor id is " + str(get_me_id(article_id)))
-        logger.info(str(type(get_me_id(article_id))))
-        editor.auth_id = `int(get_me_id(article_id))`
+        logger.info("editor id is " + str(record.editor_id))
+        editor.auth_id = `int(record.editor_id)`
         affiliation = ContributorAffiliation()
-        department = get_me_department(article_id)
+        department = record.editor_department
         if department.strip() != "":
             affiliation.department = department
-        affiliation.institution = get_me_institution(article_id)
-        affiliation.country = get_me_country(article_id)
+        affiliation.institution = record.editor_institution
+        affiliation.country = record.editor_country
 
         # editor.auth_id = `int(author_id)`we have a me_id, but I need to determine
         # whether that Id is the same as the relevent author id
@@ -313,7 +320,7 @@ def set_editor_info(article, article_id):
         logger.error("could not set editor")
         return False
 
-def set_funding(article, article_id):
+def set_funding(article, record):
     """
     Instantiate one eLifeFundingAward for each funding award
     Add principal award recipients in the order of author position for the article
@@ -322,22 +329,24 @@ def set_funding(article, article_id):
     logger.info("in set_funding")
     try:
         # Set the funding note from the manuscript level
-        article.funding_note = get_funding_note(article_id)
-
-        # Query for all funding award data keys
-        funder_ids = get_funding_ids(article_id)
+        article.funding_note = record.funding_note
 
         # Keep track of funding awards by position in a dict
         funding_awards = {}
+        # and the funder positions of each principal award recipient author_id
+        recipient_funder_positions = {}
 
         # First pass, build the funding awards
-        for (article_id, author_id, funder_position) in funder_ids:
-            #print (article_id, author_id, funder_position)
-            funder_identifier = get_funder_identifier(article_id, author_id, funder_position)
-            funder = decode_cp1252(clean_funder(get_funder(article_id, author_id, funder_position)))
-            award_id = get_award_id(article_id, author_id, funder_position)
+        for funding_values in record.funding:
+            funder_position = funding_values["funder_position"]
+            funder_identifier = funding_values["funder_identifier"]
+            funder = funding_values["funder"]
+            award_id = funding_values["award_id"]
+
+            recipient_funder_positions.setdefault(
+                funding_values["author_id"], []).append(funder_position)
 
-            if funder_position not in funding_awards.keys():
+            if funder_position not in funding_awards:
                 # Initialise the object values
                 funding_awards[funder_position] = eLifeFundingAward()
                 if funder:
@@ -348,11 +357,9 @@ def set_funding(article, article_id):
                     funding_awards[funder_position].add_award_id(award_id)
 
         # Second pass, add the primary award recipients in article author order
-        for position, award in funding_awards.iteritems():
-            for contrib in article.contributors:
-                for (article_id, author_id, funder_position) in funder_ids:
-                    if position == funder_position and contrib.auth_id == author_id:
-                        funding_awards[position].add_principal_award_recipient(contrib)
+        for contrib in article.contributors:
+            for position in recipient_funder_positions.get(contrib.auth_id, []):
+                funding_awards[position].add_principal_award_recipient(contrib)
 
         # Add funding awards to the article object, sorted by position
         for position, award in sorted(funding_awards.iteritems()):
@@ -363,23 +370,135 @@ def set_funding(article, article_id):
         logger.error("could not set funding")
         return False
 
-def write_xml(article_id, xml, dir=''):
-    f = open(dir + os.sep + 'elife_poa_e' + str(int(article_id)).zfill(5) + '.xml', "wb")
-    f.write(xml.prettyXML())
-    f.close()
+def get_xml_file_name(article_id):
+    return 'elife_poa_e' + str(int(article_id)).zfill(5) + '.xml'
+
+def write_xml(article_id, xml, dir='', skip_unchanged=False):
+    return write_xml_file(dir + os.sep + get_xml_file_name(article_id), xml.prettyXML(),
+                          skip_unchanged)
+
+# The comment added to each XML file, which changes on every run
+GENERATED_COMMENT_PATTERN = re.compile(r'<!--generated by eLife at .*? from version .*?-->')
 
-def build_article_for_article(article_id):
+def get_xml_content_hash(xml_string):
     """
-    Given an article_id, instantiate and populate the eLifePOA article object
-    Refactored for easier testing, but primarily used by build_xml_for_article
+    Hash of the XML ignoring the generated by comment
     """
-    error_count = 0
-    error_messages = []
+    return hashlib.md5(GENERATED_COMMENT_PATTERN.sub('', xml_string, count=1)).hexdigest()
 
-    # Only happy with string article_id - cast it now to be safe!
-    article_id = str(article_id)
+def is_xml_file_unchanged(path, xml_string):
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as open_file:
+        existing_xml_string = open_file.read()
+    return get_xml_content_hash(existing_xml_string) == get_xml_content_hash(xml_string)
 
-    article = instantiate_article(article_id)
+def write_xml_file(path, xml_string, skip_unchanged=False):
+    """
+    Write to a temporary file renamed to path once complete,
+    so a stopped run never leaves a partly written XML file
+    With skip_unchanged an existing file with the same XML, apart from
+    the generated by comment, is left alone
+    Returns True if the file was written, False if it was unchanged
+    """
+    if skip_unchanged and is_xml_file_unchanged(path, xml_string):
+        return False
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(temp_path, "wb") as open_file:
+            open_file.write(xml_string)
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return True
+
+class XmlWriter():
+    """
+    Writes XML files in a background thread so the next article is built
+    while the last one is written, queueing at most queue_size files
+    """
+
+    def __init__(self, queue_size=None, skip_unchanged=False):
+        if queue_size is None:
+            queue_size = settings.XML_WRITE_QUEUE_SIZE
+        self.queue = Queue.Queue(queue_size)
+        self.skip_unchanged = skip_unchanged
+        self.failed = []
+        self.unchanged = []
+        self.file_count = 0
+        self.byte_count = 0
+        self.write_seconds = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            article_id, path, xml_string = item
+            start_time = time.time()
+            try:
+                if write_xml_file(path, xml_string, self.skip_unchanged):
+                    self.file_count += 1
+                    self.byte_count += len(xml_string)
+                    logger.info("xml written for " + article_id)
+                else:
+                    self.unchanged.append(article_id)
+                    logger.info("xml unchanged for " + article_id)
+            except:
+                logger.error("could not write xml for " + article_id)
+                self.failed.append(article_id)
+            self.write_seconds += time.time() - start_time
+
+    def write(self, article_id, xml, dir=''):
+        """
+        Queue the XML of an article, waiting while the queue is full
+        """
+        self.write_string(article_id, xml.prettyXML(), dir)
+
+    def write_string(self, article_id, xml_string, dir=''):
+        path = dir + os.sep + get_xml_file_name(article_id)
+        self.queue.put((str(article_id), path, xml_string))
+
+    def close(self):
+        """
+        Wait for the queued files to be written
+        Returns the article_id values which could not be written
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        return self.failed
+
+    def log_summary(self):
+        message = "wrote " + str(self.file_count) + " XML files, %.1f KB in %.3fs" % (
+            self.byte_count / 1024.0, self.write_seconds)
+        if self.write_seconds > 0:
+            message += ", %.1f files/s, %.1f KB/s" % (
+                self.file_count / self.write_seconds,
+                self.byte_count / 1024.0 / self.write_seconds)
+        if self.skip_unchanged:
+            message += ", " + str(len(self.unchanged)) + " XML files unchanged"
+        print message
+        logger.info(message)
+
+# When set, output_xml_for_article queues files on it instead of writing them
+xml_writer = None
+# When True, output_xml_for_article leaves XML files alone if only the generated by comment changed
+skip_unchanged_xml = False
+
+def build_article_for_record(record):
+    """
+    Instantiate and populate the eLifePOA article object from an ArticleRecord
+    Returns the article and the names of the set functions which failed
+    """
+    failed_functions = []
+
+    article = instantiate_article(record)
 
     # Run each of the below functions to build the article object components
     article_set_functions = [set_title, set_abstract, set_articleType, set_license,
@@ -387,62 +506,447 @@ def build_article_for_article(article_id):
                             set_organsims, set_author_info, set_editor_info, set_keywords,
                             set_funding]
     for set_function in article_set_functions:
-        if not set_function(article, article_id):
-            error_count = error_count + 1
-            error_messages.append("article_id " + str(article_id)
-                                  + " error in " + set_function.__name__)
+        if not set_function(article, record):
+            failed_functions.append(set_function.__name__)
+
+    # Values which could not be decoded are not written to the XML
+    if record.undecoded_columns:
+        logger.warning("article_id " + str(record.article_id) + " could not decode " +
+                       ", ".join(record.undecoded_columns))
+        failed_functions.append("decode_xls_cell")
 
     # Building from CSV data it must be a POA type, set it
     if article:
         article.is_poa = True
 
-    print error_count
-
     # default conflict text
     if article:
         article.conflict_default = "The authors declare that no competing interests exist."
 
+    return article, failed_functions
+
+def build_article_for_article(article_id, record=None):
+    """
+    Given an article_id, instantiate and populate the eLifePOA article object
+    from the ArticleRecord of its CSV data, which is looked up if not supplied
+    Refactored for easier testing, but primarily used by build_xml_for_article
+    """
+    # Only happy with string article_id - cast it now to be safe!
+    article_id = str(article_id)
+
+    if record is None:
+        record = get_article_record(article_id)
+
+    article, failed_functions = build_article_for_record(record)
+
+    error_count = len(failed_functions)
+    error_messages = []
+    for function_name in failed_functions:
+        error_messages.append("article_id " + str(article_id) + " error in " + function_name)
+
+    print error_count
+
     if error_count == 0:
         return article, error_count, error_messages
     else:
         return None, error_count, error_messages
 
-def build_xml_for_article(article_id):
-    article, error_count, error_messages = build_article_for_article(article_id)
-    if article:
-        return output_xml_for_article(article, article_id)
+def build_xml_result(article_id, record=None):
+    """
+    Generate XML for one article, returning a dict of its article_id, success,
+    the names of the set functions which failed, the write_article_xml value,
+    and the seconds taken to build the article object, to serialize it to XML
+    and to write or queue the XML file
+    """
+    article_id = str(article_id)
+    result = {"article_id": article_id,
+              "success": False,
+              "failed_functions": [],
+              "output": None,
+              "build_seconds": None,
+              "serialize_seconds": None,
+              "write_seconds": None}
+
+    start_time = time.time()
+    if record is None:
+        record = get_article_record(article_id)
+    article, result["failed_functions"] = build_article_for_record(record)
+    result["build_seconds"] = time.time() - start_time
+
+    if article and not result["failed_functions"]:
+        start_time = time.time()
+        xml_string = serialize_article_xml(article, article_id)
+        result["serialize_seconds"] = time.time() - start_time
+        if xml_string is not None:
+            start_time = time.time()
+            result["output"] = write_article_xml(article_id, xml_string)
+            result["write_seconds"] = time.time() - start_time
+        result["success"] = result["output"] is not None
+        logger.info("built " + article_id + " in %.3fs, serialized in %.3fs" %
+                    (result["build_seconds"], result["serialize_seconds"]))
     else:
         logger.warning("the following article did not have enough components and " +
-                       "xml was not generated " + str(article_id))
-        logger.warning("warning count was " + str(error_count))
-        if len(error_messages) > 0:
-            logger.warning(", ".join(error_messages))
-        return False
+                       "xml was not generated " + article_id)
+        logger.warning("warning count was " + str(len(result["failed_functions"])))
+        if result["failed_functions"]:
+            logger.warning(", ".join(["article_id " + article_id + " error in " + function_name
+                                      for function_name in result["failed_functions"]]))
+    return result
+
+def build_xml_for_articles(article_ids):
+    """
+    Generate XML for each article_id, returning the build_xml_result of each in the same order
+    """
+    results = []
+    for article_id in article_ids:
+        results.append(build_xml_result(article_id))
+    return results
+
+def build_xml_for_article(article_id, record=None):
+    return build_xml_result(article_id, record)["success"]
 
 def output_xml_for_article(article, article_id):
+    return output_article_xml(article, article_id) is not None
+
+def output_article_xml(article, article_id):
+    """
+    Generate and write the XML of an article, returning "written", "unchanged",
+    or "queued" on the xml_writer, or None if it could not be generated or written
+    """
+    xml_string = serialize_article_xml(article, article_id)
+    if xml_string is None:
+        return None
+    return write_article_xml(article_id, xml_string)
+
+def serialize_article_xml(article, article_id):
+    """
+    The XML string of an article, or None if it could not be generated
+    """
     try:
-        article_xml = eLife2XML(article)
+        xml_string = eLife2XML(article).prettyXML()
         logger.info("generated xml for " + str(article_id))
-        write_xml(article_id, article_xml, dir=settings.TARGET_OUTPUT_DIR)
-        logger.info("xml written for " + str(article_id))
-        print "written " + str(article_id)
-        return True
+        return xml_string
     except:
-        logger.error("could not generate or write xml for " + str(article_id))
-        return False
+        logger.error("could not generate xml for " + str(article_id))
+        return None
+
+def write_article_xml(article_id, xml_string):
+    """
+    Write the XML string of an article, returning "written", "unchanged",
+    or "queued" on the xml_writer, or None if it could not be written
+    """
+    try:
+        xml_file = settings.TARGET_OUTPUT_DIR + os.sep + get_xml_file_name(article_id)
+        if xml_writer is None:
+            if write_xml_file(xml_file, xml_string, skip_unchanged=skip_unchanged_xml):
+                output = "written"
+                logger.info("xml written for " + str(article_id))
+            else:
+                output = "unchanged"
+                logger.info("xml unchanged for " + str(article_id))
+        else:
+            xml_writer.write_string(article_id, xml_string, dir=settings.TARGET_OUTPUT_DIR)
+            output = "queued"
+        print output + " " + str(article_id)
+        return output
+    except:
+        logger.error("could not write xml for " + str(article_id))
+        return None
 
 
 @memoize
 def index_manuscripts_on_article_id():
     return index_table_on_article_id("manuscript")
 
-if __name__ == "__main__":
+def read_fingerprint_ledger(path):
+    """
+    The fingerprint of the CSV rows of each article_id when its XML was last generated
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as open_file:
+        return json.load(open_file)
+
+def write_fingerprint_ledger(path, ledger):
+    temp_path = path + "." + str(os.getpid()) + ".tmp"
+    with open(temp_path, 'wb') as open_file:
+        json.dump(ledger, open_file, indent=0, sort_keys=True)
+    os.rename(temp_path, path)
+
+def is_article_changed(record, ledger):
+    """
+    An article is changed if its CSV rows changed or its XML file is missing
+    """
+    if ledger.get(record.article_id) != record.fingerprint:
+        return True
+    xml_file = settings.TARGET_OUTPUT_DIR + os.sep + get_xml_file_name(record.article_id)
+    return not os.path.exists(xml_file)
+
+def iter_manuscript_records(stream=False):
+    """
+    The ArticleRecord of each article with a manuscript row, with stream
+    the CSV files are read one article at a time, for exports too large to index in memory
+    """
+    if stream:
+        for record in iter_article_records():
+            if "manuscript" in record.table_types:
+                yield record
+    else:
+        for article_id in get_manuscript_article_ids():
+            yield get_article_record(article_id)
+
+def get_manuscript_article_ids():
+    """
+    The article_id of each article with a manuscript row
+    """
+    # check all the CSV files can be read before starting
+    load_xls_files()
+
     # get a list of active article numbers
     #article_ids = index_authors_on_article_id().keys()
-    article_ids = index_manuscripts_on_article_id().keys()
+    return get_article_ids("manuscript")
 
-    for article_id in article_ids:
-        print "working on ", article_id
-        xml = build_xml_for_article(article_id)
-        logging.info("")
-        logging.error("")
+def build_xml_for_record(record):
+    """
+    Generate XML for one record, returning the fingerprint and the build_xml_result,
+    so it can be run in a process pool
+    """
+    print "working on ", record.article_id
+    return record.fingerprint, build_xml_result(record.article_id, record)
+
+def build_xml_for_records(records, ledger=None, workers=1):
+    """
+    Generate XML for each record, with a ledger only for those changed since the ledger
+    was updated, recording the fingerprint of each article generated in the ledger
+    With more than one worker the records are generated in a pool of processes.
+    Returns a summary of the article_id values generated, failed and unchanged,
+    and those generated whose XML file was unchanged
+    """
+    summary = {"generated": [], "failed": [], "unchanged": [], "unchanged_files": []}
+
+    def changed_records():
+        for record in records:
+            if ledger is not None and not is_article_changed(record, ledger):
+                logger.info("unchanged " + str(record.article_id))
+                summary["unchanged"].append(record.article_id)
+                continue
+            yield record
+
+    changed = changed_records()
+    if isinstance(records, list):
+        # A list of records is shared with the worker processes, see map_records
+        changed = list(changed)
+    for fingerprint, result in map_records(build_xml_for_record, changed, workers):
+        add_result_to_summary(summary, result, fingerprint, ledger)
+    return summary
+
+def add_result_to_summary(summary, result, fingerprint, ledger=None):
+    if result["success"]:
+        summary["generated"].append(result["article_id"])
+        if result["output"] == "unchanged":
+            summary["unchanged_files"].append(result["article_id"])
+        if ledger is not None:
+            ledger[result["article_id"]] = fingerprint
+    else:
+        summary["failed"].append(result["article_id"])
+
+def build_xml_for_article_id(args):
+    """
+    Generate XML for one article_id, reading its ArticleRecord from the CSV_DATABASE
+    on the connection of the worker process. args are the article_id and its fingerprint
+    in the ledger, or None. Returns the article_id, the fingerprint and the
+    build_xml_result, which is None if the article is unchanged since the ledger
+    """
+    article_id, ledger_fingerprint = args
+    record = get_article_record(article_id)
+    if ledger_fingerprint is not None and not is_article_changed(
+            record, {record.article_id: ledger_fingerprint}):
+        return record.article_id, record.fingerprint, None
+    fingerprint, result = build_xml_for_record(record)
+    return record.article_id, fingerprint, result
+
+def build_xml_for_article_ids(article_ids, ledger=None, workers=1):
+    """
+    Generate XML for each article_id with a CSV_DATABASE, each worker process reads
+    the records from its own connection so the records are not all held in memory
+    Returns a summary the same as build_xml_for_records
+    """
+    summary = {"generated": [], "failed": [], "unchanged": [], "unchanged_files": []}
+    tasks = [(str(article_id), ledger.get(str(article_id)) if ledger is not None else None)
+             for article_id in article_ids]
+    for article_id, fingerprint, result in map_in_pool(build_xml_for_article_id, tasks, workers):
+        if result is None:
+            logger.info("unchanged " + article_id)
+            summary["unchanged"].append(article_id)
+        else:
+            add_result_to_summary(summary, result, fingerprint, ledger)
+    return summary
+
+# The records of the running pool keyed on article_id, set before the worker processes
+# are forked so each has a copy of them and is only sent the article_id of a record
+shared_records = {}
+
+def call_with_shared_record(args):
+    function, article_id = args
+    return function(shared_records[article_id])
+
+def map_records(function, records, workers=1):
+    """
+    Yield the result of the function for each record, in order
+    With more than one worker the function is run in a pool of processes,
+    forked after the CSV files are loaded so they share the loaded data.
+    A list of records is shared with the worker processes in the same way,
+    records from any other iterable, such as a stream, are sent to them
+    """
+    global shared_records
+    if workers > 1 and isinstance(records, list):
+        shared_records = dict([(record.article_id, record) for record in records])
+        tasks = [(function, record.article_id) for record in records]
+        try:
+            for result in map_in_pool(call_with_shared_record, tasks, workers):
+                yield result
+        finally:
+            shared_records = {}
+    else:
+        for result in map_in_pool(function, records, workers):
+            yield result
+
+def map_in_pool(function, items, workers=1):
+    """
+    Yield the result of the function for each item, in order, in a pool of processes
+    with more than one worker, each item is sent to the worker process
+    """
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap(function, items):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for result in itertools.imap(function, items):
+            yield result
+
+def validate_record(record):
+    """
+    Build the article object of one record without generating XML,
+    returning the article_id and the names of the functions which failed
+    """
+    article, failed_functions = build_article_for_record(record)
+    if article is None:
+        failed_functions.insert(0, "instantiate_article")
+    return record.article_id, failed_functions
+
+def validate_records(records, workers=1):
+    """
+    Check the article object of every record can be built, without generating XML
+    Returns a list of (article_id, failed function names) for each record
+    """
+    return list(map_records(validate_record, records, workers))
+
+def validate_article_id(article_id):
+    return validate_record(get_article_record(article_id))
+
+def validate_article_ids(article_ids, workers=1):
+    """
+    Check the article object of every article_id can be built with a CSV_DATABASE,
+    each worker process reads the records from its own connection
+    """
+    return list(map_in_pool(validate_article_id, article_ids, workers))
+
+def log_validation_report(results):
+    failed_count = 0
+    for article_id, failed_functions in results:
+        if failed_functions:
+            failed_count += 1
+            message = "article_id " + str(article_id) + " failed: " + ", ".join(failed_functions)
+            print message
+            logger.warning(message)
+    message = "validated " + str(len(results)) + ", failed " + str(failed_count)
+    print message
+    logger.info(message)
+
+def log_generation_summary(summary, skip_unchanged=False):
+    message = ("generated " + str(len(summary["generated"])) + ", failed " +
+               str(len(summary["failed"])) + ", unchanged " + str(len(summary["unchanged"])))
+    if skip_unchanged:
+        message += (", XML files written " +
+                    str(len(summary["generated"]) - len(summary["unchanged_files"])) +
+                    ", XML files unchanged " + str(len(summary["unchanged_files"])))
+    if summary["failed"]:
+        message += ", failed article_id: " + ", ".join(summary["failed"])
+    print message
+    logger.info(message)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate POA XML from the CSV files")
+    parser.add_argument("--stream", action="store_true",
+                        help="read the CSV files one article at a time, for very large exports")
+    parser.add_argument("--import-database", action="store_true",
+                        help="import the CSV files into the CSV_DATABASE SQLite file and exit")
+    parser.add_argument("--force", action="store_true",
+                        help="generate every article, including those unchanged since FINGERPRINT_LEDGER")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes generating articles at the same time")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="leave XML files alone when only the generated by comment changed")
+    parser.add_argument("--validate", action="store_true",
+                        help="only check each article can be built, without generating XML")
+    args = parser.parse_args()
+
+    if args.import_database:
+        if not settings.CSV_DATABASE:
+            parser.error("CSV_DATABASE is not configured")
+        import_xls_files_to_database(settings.CSV_DATABASE)
+    elif args.validate:
+        if args.workers > 1 and settings.CSV_DATABASE and not args.stream:
+            results = validate_article_ids(get_manuscript_article_ids(), args.workers)
+        else:
+            records = iter_manuscript_records(args.stream)
+            if args.workers > 1 and not args.stream:
+                # Load the records before the worker processes are forked
+                records = list(records)
+            results = validate_records(records, args.workers)
+        log_validation_report(results)
+        log_xls_load_summary()
+    else:
+        ledger = None
+        if settings.FINGERPRINT_LEDGER:
+            if args.force:
+                ledger = {}
+            else:
+                ledger = read_fingerprint_ledger(settings.FINGERPRINT_LEDGER)
+        # Resolve the generated by comment once, before any worker processes are forked
+        get_provenance()
+        skip_unchanged_xml = args.skip_unchanged
+        if args.workers == 1:
+            # Worker processes each write their own files, a thread is not forked with them
+            xml_writer = XmlWriter(skip_unchanged=skip_unchanged_xml)
+        try:
+            if args.workers > 1 and settings.CSV_DATABASE and not args.stream:
+                summary = build_xml_for_article_ids(get_manuscript_article_ids(), ledger,
+                                                    args.workers)
+            else:
+                records = iter_manuscript_records(args.stream)
+                if args.workers > 1 and not args.stream:
+                    # Load the records before the worker processes are forked
+                    records = list(records)
+                summary = build_xml_for_records(records, ledger, args.workers)
+            if xml_writer is not None:
+                for article_id in xml_writer.close():
+                    summary["generated"].remove(article_id)
+                    summary["failed"].append(article_id)
+                summary["unchanged_files"].extend(xml_writer.unchanged)
+                xml_writer.log_summary()
+            log_generation_summary(summary, skip_unchanged_xml)
+        finally:
+            if xml_writer is not None:
+                # Only record the articles whose files were written
+                for article_id in xml_writer.close():
+                    if ledger is not None:
+                        ledger.pop(article_id, None)
+            # Keep the articles generated so far even if the run is stopped
+            if ledger is not None:
+                write_fingerprint_ledger(settings.FINGERPRINT_LEDGER, ledger)
+            log_xls_load_summary()